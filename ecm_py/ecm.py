@@ -104,6 +104,7 @@ find_one_factor_and_stop = 0
 
 
 # This controls how often (in seconds) python reads in job files from the hard drive
+# Job files are also read as soon as GMP-ECM finishes a curve, finds a factor or exits
 # Can be overidden on the command line with -pollfiles N
 # --- Recommended settings ---
 # For quick jobs (less than a couple of hours): between 3 and 15 seconds
@@ -112,6 +113,11 @@ find_one_factor_and_stop = 0
 # For large jobs (less than a month): between 120 and 360 seconds
 poll_file_delay = 15
 
+# With -resume, each instance of GMP-ECM is started on a batch of this many resume lines
+# taken from a shared list, instances that finish early take the next batch.
+# 0 picks a size that gives each instance about 10 batches.
+resume_batch_size = 0
+
 
 # This controls how often we print runtime info to our log file
 # The following two lines are examples of what is printed out at each interval:
@@ -228,16 +234,20 @@ using_line = ''
 need_version_info = True
 version_info = ''
 time_str = ''
-# create a file sizes dictionary to store how large each of our in-progress output files are
-# this will help us to reduce the number of times we read in the whole file for processing
-file_sizes = {}
-first_getsizes = True
+# tail state (byte offset, partial line, running totals) of each of our in-progress output files
+# so each poll only reads and parses what was appended since the last one, see tail_job_file()
+job_file_tails = {}
 actual_num_threads = 1
 ecm_c_completed_per_file = {}
 ecm_s1_completed_per_file = {}
 tt_stg1_per_file = {}
 tt_stg2_per_file = {}
 e_total = -1.0
+curves_left = 0 # curves of the current number not yet given to an instance of gmp-ecm...
+number_procs = [] # instances of gmp-ecm working on the current number...
+next_thread = 0 # index of the next _tNN output file of the current number...
+number_ret = 0 # return codes of the finished instances of the current number...
+next_gather = 0 # when to read the current number's output files if there are no events from them...
 next_email_interval = 60*email_interval_minutes
 next_log_interval = log_interval_seconds # log progress info once per day...
 inp_file = '' # used with the -inp option...
@@ -247,14 +257,36 @@ ecm_resume_job = False # will be set to True when using the -resume option
 threadList = [] # used to keep track of -resume work...
 files_c = [] # total amount of curves completed in each of our files...
 files_t2 = [] # total amount of Step 2 time in each of our files...
-files_sizes = [] # size each of our files, used to detect when there is a change...
+resume_batches_c = 0 # curves completed in resume batches that have finished...
+resume_batches_t2 = 0.0 # Step 2 time of resume batches that have finished...
 num_resume_lines = 0
 tot_c_completed = 0
 prev_c_completed = 0
 job_start = 0
 
+# Globals that belong to the number being worked on.  Several numbers can be worked on at the
+# same time (see run_ecm_numbers), so these are saved and loaded when switching between them.
+NUMBER_STATE = ('ecm_n', 'ecm_job', 'ecm_c', 'ecm_args', 'ecm_args1', 'ecm_args2',
+                'ecm_c_completed', 'tt_stg1', 'tt_stg2', 'ecm_s1_completed',
+                'prev_ecm_c_completed', 'prev_tt_stg1', 'prev_tt_stg2', 'prev_ecm_s1_completed',
+                'ecm_c_completed_per_file', 'ecm_s1_completed_per_file', 'tt_stg1_per_file', 'tt_stg2_per_file',
+                'factor_found', 'factor_value', 'factor_data', 'remaining_composites',
+                'job_complete', 'ecm_c_has_changed', 'need_using_line', 'using_line',
+                'need_version_info', 'version_info', 'time_str', 'actual_num_threads', 'job_start', 'e_total',
+                'curves_left', 'number_procs', 'next_thread', 'number_ret', 'next_gather')
+
 # Utillity Routines
 
+def save_number_state():
+  '''the globals of the current number (see NUMBER_STATE)'''
+  return {name: globals()[name] for name in NUMBER_STATE}
+
+
+def load_number_state(state):
+  '''make the number saved in state the current number'''
+  globals().update(state)
+
+
 def die(x, rv = -1):
   '''print an error message and exit'''
   output(x)
@@ -351,9 +383,46 @@ def check_binary(exe):
       sys.exit(-1)
 
 
+def tee_output(p, out_f, events):
+  '''
+  Copy the output of p to out_f as it is written and tell events (a Queue) about it:
+    (p, 'curve') after each Step 2 line
+    (p, 'factor') after the line following "Found ... factor" (so the cofactor line is in out_f)
+    (p, 'exit') once all output has been copied and p has finished
+  '''
+  found = False
+  with out_f:
+    for line in iter(p.stdout.readline, b''):
+      out_f.write(line)
+      out_f.flush()
+      if found:
+        found = False
+        events.put((p, 'factor'))
+      if line.startswith(b'Found'):
+        found = True
+      elif line.startswith(b'Step 2 took'):
+        events.put((p, 'curve'))
+  p.wait()
+  events.put((p, 'exit'))
+
+
+def wait_for_ecm_events(timeout):
+  '''wait up to timeout seconds for events from tee_output, returns all events that are ready'''
+  global ecm_events
+
+  events = []
+  try:
+    events.append(ecm_events.get(timeout = timeout))
+    while True:
+      events.append(ecm_events.get_nowait())
+  except Empty:
+    pass
+  return events
+
+
 def run_exe(exe, args, inp = '', in_file = None, out_file = None,
-            log = True, display = VERBOSE, wait = True, resume = 0):
-  '''run an executable file'''
+            log = True, display = VERBOSE, wait = True, resume = 0, tee = None):
+  '''run an executable file, with tee (a Queue) output is copied to out_file by tee_output'''
   al = {} if VERBOSE else {'creationflags' : 0x08000000 }
   if sys.platform.startswith('win'):
 #   priority_high = 0x00000080
@@ -371,6 +440,11 @@ def run_exe(exe, args, inp = '', in_file = None, out_file = None,
     if out_file == subprocess.PIPE:
       md = ' > PIPE'
       al['stdout'] = subprocess.PIPE
+    elif tee is not None:
+      md = (' >> ' if os.path.exists(out_file) else ' > ') + out_file
+      al['stdout'] = subprocess.PIPE
+      # opened here so out_file exists as soon as we return
+      tee_f = open(out_file, 'ab')
     elif os.path.exists(out_file):
       md = ' >> ' + out_file
       al['stdout'] = open(out_file, 'a')
@@ -400,6 +474,9 @@ def run_exe(exe, args, inp = '', in_file = None, out_file = None,
   #p = subprocess.Popen([ex] + args.split(' '), **al)
   #p = subprocess.Popen(cs.split(' '), **al)
 
+  if tee is not None and out_file:
+    threading.Thread(target = tee_output, args = (p, tee_f, tee), daemon = True).start()
+
   if not wait:
     return p
 
@@ -459,55 +536,55 @@ def sendemail(from_addr, to_addr_list, cc_addr_list,
     write_string_to_log(str(e))
 
 procs = []  # list of thread popen instances
+ecm_events = Queue()  # (proc, 'curve' | 'factor' | 'exit') from the tee_output threads of procs
+
+def terminate_procs(ps):
+  '''terminate the instances of gmp-ecm in ps that are still running'''
+  for p in ps:
+    if p.poll() == None:
+      try:
+        p.terminate()
+      except:
+        pass
+        #print('-> *** WARNING *** WARNING *** WARNING *** Termination exception! ***')
+      time.sleep(0.1)
+
 
 def terminate_ecm_threads():
   global procs
   if procs:
-    for p in procs:
-      if p.poll() == None:
-        try:
-          p.terminate()
-        except:
-          pass
-          #print('-> *** WARNING *** WARNING *** WARNING *** Termination exception! ***')
-        time.sleep(0.1)
+    terminate_procs(procs)
     del procs[:]
     #print('-> ecm terminated')
 
 
-def start_ecm_threads():
-  global procs, ecm_c, intNumThreads, ecm_job, actual_num_threads
-
-  #make sure there are no other ecm processes running or stored in procs...
-  terminate_ecm_threads()
+def start_ecm_instance():
+  '''
+  Start another instance of gmp-ecm on the current number with the next share of its curves.
+  Each instance gets (at most) ecm_c/intNumThreads curves, like when all threads start
+  on a number at once, or runs until stopped when ecm_c == 0.
+  '''
+  global procs, number_procs, ecm_c, ecm_job, ecm_args1, curves_left, next_thread, ecm_events
 
   ecm_job_prefix = ecm_job.split('.')[0]
-
-  old_handler = signal.signal(signal.SIGINT, terminate_ecm_threads)
+  file_name = ecm_job_prefix + '_t' + str(next_thread).zfill(2) + '.txt'
+  next_thread += 1
 
   if ecm_c == 0:
-    num = intNumThreads
+    args = ecm_args1
   else:
-    num = ecm_c if (ecm_c < intNumThreads) else intNumThreads
-
-  actual_num_threads = num
-  if VERBOSE >= v_normal:
-    print('-> Starting {0:d} instance{1:s} of GMP-ECM...'
-        .format(num, '' if (num == 1) else 's'))
-  write_string_to_log('-> Starting {0:d} instance{1:s} of GMP-ECM...'.format(num, '' if (num == 1) else 's'))
-
-  assert intNumThreads >= 1
-
-  count, remainder = divmod(ecm_c, intNumThreads)
-  for i in range(intNumThreads):
-    file_name = ecm_job_prefix + '_t' + str(i).zfill(2) + '.txt'
-    if ecm_c == 0 or i >= remainder:
-        procs.append(run_exe(ECM, ecm_args1, in_file = ecm_job, out_file = file_name, wait = False))
+    curves = min(curves_left, -(-ecm_c // intNumThreads))
+    curves_left -= curves
+    # ecm_args1 doesn't have -c when it was made for a single curve
+    if ' -c ' in ecm_args1:
+      args = re.sub(' -c [0-9]+', ' -c {0:d}'.format(curves), ecm_args1, count = 1)
     else:
-        procs.append(run_exe(ECM, ecm_args2, in_file = ecm_job, out_file = file_name, wait = False))
+      args = ' -c {0:d}'.format(curves) + ecm_args1
+
+  p = run_exe(ECM, args, in_file = ecm_job, out_file = file_name, wait = False, tee = ecm_events)
+  number_procs.append(p)
+  procs.append(p)
 
-  print(' ')
-  signal.signal(signal.SIGINT, old_handler)
 
 def get_ecm_type_and_count(args):
   parts = args.split(' ')
@@ -577,74 +654,148 @@ def parse_ecm_timing_line(line):
   return None
 
 
-def parse_job_file(job_filename):
+def new_job_file_state():
+  """Running totals of a job file, filled in by parse_job_lines"""
+  return {
+      'offset': 0,        # bytes of the file that have been read
+      'partial': b'',     # last line, if ecm hasn't finished writing it
+      'last_line': '',
+      # These will be the last matching using, version, timing
+      'using_info': None,
+      'version_info': None,
+      'time_info': None,
+      # List of tuple of (using, found lines)
+      'factors_found': [],
+      # Composite cofactors reported after a factor, in file order
+      'cofactors': [],
+      'step1_complete': 0,
+      'step1_timing': 0.0,
+      'step2_complete': 0,
+      'step2_timing': 0.0,
+      # Factors found in Step 1 (these curves / resume lines have no Step 2 line)
+      'step1_factors': 0,
+  }
+
+
+def parse_job_lines(state, lines):
+  """Fold lines of a job file into state (see new_job_file_state)"""
+  # TODO(seth): deduplicate this with get_out_fin, find_factor_info
+
+  last_line = state['last_line']
+  for line in lines:
+    line = line.strip()
+
+    if 'composite cofactor' in line.lower():
+      state['cofactors'].append(line.split(' ')[2])
+
+    if 'Factor found in step 1' in line:
+      state['step1_factors'] += 1
+
+    if line.startswith('Using'):
+      state['using_info'] = line # if a factor was found, this will contain its B1, B2, and sigma...
+    elif line.startswith('GMP-ECM'):
+      state['version_info'] = line
+
+    elif line.startswith('APR primality'):
+      # Appears between Factor found and factor.
+      continue
+
+    elif 'Factor found' in last_line:
+      # TODO(seth): Old code was worried about a line starting with "Run"
+      # between "Found found" and factor line. No idea what that was avoiding.
+      assert not line.startswith('Run'), ("PLEASE REPORT TO THE FORUM: " + line)
+      state['factors_found'].append((state['using_info'], last_line + '\n' + line))
+
+    else:
+      parsed = parse_ecm_timing_line(line)
+      if parsed:
+        if parsed[0] == 1:
+          state['step1_complete'] += 1
+          state['step1_timing'] += parsed[1]
+          state['time_info'] = line
+        elif parsed[0] == 2:
+          state['step2_complete'] += 1
+          state['step2_timing'] += parsed[1]
+          if state['time_info']:
+            state['time_info'] += "\n" + line
+          else:
+            # resume output has no Step 1 lines
+            state['time_info'] = line
+
+    last_line = line
+
+  state['last_line'] = last_line
+
+
+def resume_lines_done(state):
+  """Number of resume lines finished in a job file, a Step 2 line or a factor found in Step 1"""
+  return state['step2_complete'] + state['step1_factors']
+
+
+def job_file_summary(state):
   """
-  Parse a job file (traditional jobXXXX_tTT.txt) to:
+  Summarize a job file state as:
     (using line, version info, time_str)
     [(using B1,B2,sigma, Found factor + factor), ...]
     (number of Step 1 complete, sum Step 1 time)
     (number of Step 2 complete, sum Step 2 time)
   """
-  # TODO(seth): deduplicate this with get_out_fin, find_factor_info
+  return (
+      (state['using_info'], state['version_info'], state['time_info']),
+      state['factors_found'],
+      (state['step1_complete'], state['step1_timing']),
+      (state['step2_complete'], state['step2_timing'])
+  )
+
+
+def read_job_file(job_filename):
+  """Parse all of a job file (traditional jobXXXX_tTT.txt), returns its state"""
   # TODO(seth): deduplicate this with find_work_done
+  state = new_job_file_state()
+  with open(job_filename, 'r') as in_file:
+    parse_job_lines(state, in_file)
+  return state
 
-  # These will be the last matching using, version, timing
-  using_info = None
-  version_info = None
-  time_info = None
 
-  # List of tuple of (using, found lines)
-  factors_found = []
-  step1_complete = 0
-  step1_timing = 0.0
-  step2_complete = 0
-  step2_timing = 0.0
+def parse_job_file(job_filename):
+  """Parse a job file (traditional jobXXXX_tTT.txt), see job_file_summary"""
+  return job_file_summary(read_job_file(job_filename))
 
-  with open(job_filename, 'r') as in_file:
-    # the number of curves completed = the number of "Step 2" lines in the file
-    for line in in_file:
-      line = line.strip()
 
-      if line.startswith('Using'):
-        using_info = line # if a factor was found, this will contain its B1, B2, and sigma...
-      elif line.startswith('GMP-ECM'):
-        version_info = line
+def tail_job_file(job_filename):
+  """
+  Parse the complete lines appended to job_filename since the last call
+  into job_file_tails[job_filename].
 
-      elif line.startswith('APR primality'):
-        # Appears between Factor found and factor.
-        continue
+  Only new bytes are read so this costs the same no matter how long ecm has
+  been running. Returns True if the state changed.
+  """
+  global job_file_tails
 
-      elif 'Factor found' in last_line:
-        # TODO(seth): Old code was worried about a line starting with "Run"
-        # between "Found found" and factor line. No idea what that was avoiding.
-        assert not line.startswith('Run'), ("PLEASE REPORT TO THE FORUM: " + line)
-        factors_found.append((using_info, last_line + '\n' + line))
+  size = os.path.getsize(job_filename)
+  state = job_file_tails.get(job_filename)
+  if state is not None and size == state['offset']:
+    return False
 
-      else:
-        parsed = parse_ecm_timing_line(line)
-        if parsed:
-          if parsed[0] == 1:
-            step1_complete += 1
-            step1_timing += parsed[1]
-            time_info = line
-          elif parsed[0] == 2:
-            step2_complete += 1
-            step2_timing += parsed[1]
-            time_info += "\n" + line
-
-      last_line = line
+  if state is None or size < state['offset']:
+    # new file (or it was truncated/replaced), start from the beginning
+    state = job_file_tails[job_filename] = new_job_file_state()
 
-  return (
-      (using_info, version_info, time_info),
-      factors_found,
-      (step1_complete, step1_timing),
-      (step2_complete, step2_timing)
-  )
+  with open(job_filename, 'rb') as in_file:
+    in_file.seek(state['offset'])
+    data = in_file.read(size - state['offset'])
+  state['offset'] += len(data)
+
+  lines = (state['partial'] + data).split(b'\n')
+  # keep any partial last line for the next call
+  state['partial'] = lines.pop()
+  parse_job_lines(state, (line.decode(errors = 'replace') for line in lines))
+  return True
 
 
-def handle_enqueue_composite_factors(factors_found, job_filename):
+def handle_enqueue_composite_factors(factors_found, cofactors):
   """
-  Find any new composites in factors_found / job_filename
+  Find any new composites in factors_found / cofactors (from a job file)
 
   Potentially add them to remaining_composites
   """
@@ -685,19 +836,14 @@ def handle_enqueue_composite_factors(factors_found, job_filename):
 
   # Kinda awful taste, but go looking for any composite cofactors in the file
   if find_one_factor_and_stop == 0:
-    with open(job_filename, 'r') as in_file:
-      # the number of curves completed = the number of "Step 2" lines in the file
-      for line in in_file:
-        line = line.strip()
-        if 'composite cofactor' in line.lower():
-          composite = line.split(' ')[2]
-          if ("~" + composite) not in remaining_composites:
-            remaining_composites += '~' + composite
+    for composite in cofactors:
+      if ("~" + composite) not in remaining_composites:
+        remaining_composites += '~' + composite
 
-            # FIXME: N/101 and N/1001 can both be queued (by seperate threads) consider how to fix.
-            # TODO(seth): Should try to find the smallest cofactor in the file
-            # Only do this once (so similiar cofactors don't queue many times)
-            break
+        # FIXME: N/101 and N/1001 can both be queued (by seperate threads) consider how to fix.
+        # TODO(seth): Should try to find the smallest cofactor in the file
+        # Only do this once (so similiar cofactors don't queue many times)
+        break
 
 
 def read_resume_file(res_file):
@@ -961,7 +1107,7 @@ def print_work_done():
                 one_line     = True)
 
 def gather_work_done(job_file):
-  global need_using_line, factor_found, factor_value, factor_data, file_sizes, first_getsizes
+  global need_using_line, factor_found, factor_value, factor_data, job_file_tails
   global ecm_s1_completed_per_file, ecm_c_completed_per_file, tt_stg1_per_file, tt_stg2_per_file
   global need_version_info, version_info, time_str, using_line, remaining_composites
 
@@ -969,20 +1115,10 @@ def gather_work_done(job_file):
     return
   job_file_prefix = job_file.split('.')[0]
   for f in glob.iglob(job_file_prefix + '_t*'):
-    if first_getsizes:
-      file_sizes[f] = os.path.getsize(f)
-
-    # using file sizes to reduce the number of times we read in the whole file for processing
-    if file_sizes[f] != os.path.getsize(f) or first_getsizes:
-      file_sizes[f] = os.path.getsize(f) #update the file size...
-
-      # the number of curves completed = the number of "Step 2" lines in the file (or +1 if a factor was found in Step 1)
-      ecm_c_completed_per_file[f] = 0
-      ecm_s1_completed_per_file[f] = 0
-      tt_stg1_per_file[f] = 0.0
-      tt_stg2_per_file[f] = 0.0
-
-      info, factors_found, (step1_complete, step1_timing), (step2_complete, step2_timing) = parse_job_file(f)
+    # only the lines ecm appended since our last poll are read and parsed
+    if tail_job_file(f):
+      state = job_file_tails[f]
+      info, factors_found, (step1_complete, step1_timing), (step2_complete, step2_timing) = job_file_summary(state)
 
       if info[0]:
         factor_data = info[0]
@@ -1006,60 +1142,337 @@ def gather_work_done(job_file):
       if info[2]:
         time_str = info[2]
 
-      ecm_s1_completed_per_file[f] += step1_complete
-      tt_stg1_per_file[f] += step1_timing
+      # the number of curves completed = the number of "Step 2" lines in the file (or +1 if a factor was found in Step 1)
+      ecm_s1_completed_per_file[f] = step1_complete
+      tt_stg1_per_file[f] = step1_timing
 
-      ecm_c_completed_per_file[f] += step2_complete
-      tt_stg2_per_file[f] += step2_timing
+      ecm_c_completed_per_file[f] = step2_complete
+      tt_stg2_per_file[f] = step2_timing
 
       if ecm_s1_completed_per_file[f] != ecm_c_completed_per_file[f]:
         # output(' *** Step 1 count != Step 2 count, but a factor was found.  Incrementing ecm_c_completed.')
         ecm_c_completed_per_file[f] += len(factors_found)
 
-      handle_enqueue_composite_factors(factors_found, f)
+      handle_enqueue_composite_factors(factors_found, state['cofactors'])
+
+
+def start_number(entry):
+  '''
+  Set up the globals (see NUMBER_STATE) and job file for entry from number_list.
+  Returns False if there are no curves to run (already finished, or resumed with a factor).
+  '''
+  global ecm_n, ecm_job, ecm_c, ecm_args, intResume, job_start
+  global factor_found, factor_value, factor_data, job_complete, ecm_c_has_changed
+  global prev_ecm_c_completed, prev_tt_stg1, prev_tt_stg2, prev_ecm_s1_completed
+  global ecm_c_completed_per_file, ecm_s1_completed_per_file, tt_stg1_per_file, tt_stg2_per_file
+  global need_using_line, need_version_info, e_total, actual_num_threads
+  global curves_left, number_procs, next_thread, number_ret, next_gather
+
+  factor_found = False
+  factor_value = ''
+  factor_data = ''
+  job_complete = False
+  ecm_c_has_changed = False
+  prev_ecm_c_completed = 0
+  prev_tt_stg1 = 0
+  prev_tt_stg2 = 0
+  prev_ecm_s1_completed = 0
+  # other numbers we are working on keep their own dictionaries (see NUMBER_STATE)
+  ecm_c_completed_per_file = {}
+  ecm_s1_completed_per_file = {}
+  tt_stg1_per_file = {}
+  tt_stg2_per_file = {}
+  e_total = -1.0
+  need_using_line = True
+  need_version_info = True
+  continue_composite = 0
+  tmp_info = []
+
+  # check to see if this ecm_n is a job we should continue...
+  ecm_n = entry
+  if ':' in ecm_n:
+    # Searh "find_one_factor_and_stop", happens when we found one factor but are continuning (and have a count of curves)
+    continue_composite = 1
+    tmp_info = ecm_n.split(':')
+    ecm_n = tmp_info[0]
+
+  my_str1 = '->============================================================================='
+  my_str2 = '-> Working on number: {0:s} ({1:d} digits)'.format(abbreviate(ecm_n), num_digits(ecm_n))
+  write_string_to_log(my_str1)
+  write_string_to_log(my_str2)
+  if VERBOSE >= v_normal:
+    print(my_str1)
+    print(my_str2)
+
+  if continue_composite == 1:
+    # XXX: Seth: I believe the point is just to update -c?
+    parse_ecm_options(ecm_args.split(), new_curves = int(tmp_info[1]), quiet = True)
+    create_job_file()
+    intResume = 1
+  elif intResume == 1:
+    output('-> Trying to resume job in file: {0:s}'.format(resume_file))
+    find_work_done()
+  elif AUTORESUME:
+    # Try to find out if we have already done work on this job
+    # If so, we'll pick up where we left off
+    # If not, we'll start a new job
+    parse_ecm_options(ecm_args.split(), quiet = True)
+    if find_job_file():
+      find_work_done()
+    else:
+      create_job_file()
+  else:
+    # If we are not manually or automatically resuming,
+    # then just create a job file and start working on it.
+    parse_ecm_options(ecm_args.split(), quiet = True)
+    create_job_file()
+
+  if factor_found or job_complete:
+    return False
+
+  my_str = '-> Currently working on: ' + ecm_job
+  if VERBOSE >= v_normal:
+    print(my_str)
+  write_string_to_log(my_str)
+  job_start = time.time()
+  if intResume == 0:
+    parse_ecm_options(ecm_args.split())
+
+  curves_left = ecm_c
+  number_procs = []
+  next_thread = 0
+  number_ret = 0
+  next_gather = time.time() + poll_file_delay
+  actual_num_threads = ecm_c if (0 < ecm_c < intNumThreads) else intNumThreads
+  if VERBOSE >= v_normal:
+    print('-> Starting {0:d} instance{1:s} of GMP-ECM...'
+        .format(actual_num_threads, '' if (actual_num_threads == 1) else 's'))
+  write_string_to_log('-> Starting {0:d} instance{1:s} of GMP-ECM...'.format(actual_num_threads, '' if (actual_num_threads == 1) else 's'))
+  return True
+
+
+def finish_number():
+  '''Report the result of the current number, enqueue any composites and delete its job files'''
+  global remaining_composites, number_list, job_file_tails
+
+  my_msg = ''
+  print('\n')
+
+  t_total = time.time() - job_start
+  if factor_found:
+# ################################################
+    line1 = 'Computer: ' + socket.gethostname()
+    line2 = 'Report Time: ' + time.strftime('%Y/%m/%d %H:%M:%S UTC', time.gmtime())
+    line3 = '{0:s}'.format(version_info)
+    line4 = 'Input number is {0:s} ({1:d} digits)'.format(ecm_n, num_digits(ecm_n))
+    line5 = 'Run {0:d} out of {1:d}:'.format(ecm_c_completed, ecm_c+prev_ecm_c_completed)
+    line6 = '{0:s}'.format(factor_data)
+    line7 = '{0:s}'.format(time_str)
+    line8 = '{0:s}'.format(factor_value)
+
+    my_msg = my_msg + line1 + '\n'
+    my_msg = my_msg + line2 + '\n\n'
+    my_msg = my_msg + line3 + '\n'
+    my_msg = my_msg + line4 + '\n'
+    my_msg = my_msg + line5 + '\n'
+    my_msg = my_msg + line6 + '\n'
+    my_msg = my_msg + line7 + '\n'
+    my_msg = my_msg + line8 + '\n'
+
+    rt = get_runtime(t_total)
+    str_stg1, t_stg1 = get_avg_str(ecm_s1_completed, tt_stg1)
+    str_stg2, t_stg2 = get_avg_str(ecm_c_completed, tt_stg2)
+    write_string_to_log('{0:6d} of {1:6d} | Stg1 {2:s} | Stg2 {3:s} | {4:s} |   0d 00:00:00'
+                         .format(ecm_c_completed, ecm_c+prev_ecm_c_completed, str_stg1, str_stg2, rt))
+
+    write_string_to_log(line3)
+    write_string_to_log(line4)
+    write_string_to_log(line5)
+    write_string_to_log(line6)
+    write_string_to_log(line7)
+    write_string_to_log(line8)
+# ################################################
+    if VERBOSE >= v_normal:
+      print('Run {0:d} out of {1:d}:'.format(ecm_c_completed, ecm_c+prev_ecm_c_completed))
+      print('{0:s}'.format(factor_data))
+      print('{0:s}'.format(time_str))
+      print('{0:s}'.format(factor_value))
+#    print('\n---------------------------------------------------------------\n')
+#    print(my_msg)
+#    print('\n---------------------------------------------------------------\n\n')
+    if save_to_file:
+      with open(output_file, 'a') as out_f:
+        out_f.write(my_msg)
+    if email_results:
+      sendemail(from_addr    = em_usr,
+                to_addr_list = em_to,
+                cc_addr_list = em_cc,
+                subject      = '[Ecm.py] Report: Factor found!',
+                message      = my_msg,
+                login        = em_usr,
+                password     = em_pwd,
+                smtpserver   = em_srv)
+
+    # if we were asked to keep working, make sure we have some composites to keep working with,
+    # if so, then calculate the new number of curves to run on those numbers, and then append those
+    # composite_num:new_curve to our number_list so we can finish the remaining number of curves on them...
+    if find_one_factor_and_stop == 0 and remaining_composites != '':
+      new_curves = ecm_c + prev_ecm_c_completed - ecm_c_completed
+      for entry in remaining_composites.split('~'):
+        if entry != '':
+          print(' ')
+          print('-> * Notice: Enqueuing composite number {0:s}'.format(abbreviate(entry, length = 40)))
+          print('-> * Notice: Will run the remaining {0:d} curves on it'.format(new_curves))
+          number_list.append(entry + ':' + str(new_curves))
+      remaining_composites = ''
+      new_curves = 0
+  else:
+# ################################################
+    print("factor_data:", factor_data)
+    ud = factor_data.split(',')
+    b1b2_info = '{0:s},{1:s},{2:s}, {3:d} thread{4:s}'.format(ud[0],ud[1],ud[2],actual_num_threads, '' if (actual_num_threads == 1) else 's')
+    zd = '{0:.0f}'.format(math.floor(t_total/86400.0)).rjust(3) + 'd '
+    zh = '{0:.0f}'.format(math.floor((t_total%86400)/3600.0)).zfill(2) + 'h '
+    zm = '{0:.0f}'.format(math.floor((t_total%3600)/60.0)).zfill(2) + 'm '
+    zs = '{0:.0f}'.format(math.floor(t_total%60.0)).zfill(2) + 's'
+    rt = zd + zh + zm + zs
+
+    line1 = 'Computer: ' + socket.gethostname()
+    line2 = 'Report Time: ' + time.strftime('%Y/%m/%d %H:%M:%S UTC', time.gmtime())
+    line3 = '{0:s}'.format(version_info)
+    line4 = 'Input number is {0:s} ({1:d} digits)'.format(ecm_n, num_digits(ecm_n))
+    line5 = b1b2_info
+    line6 = 'Finished {0:d} of {1:d} curves'.format(ecm_c_completed, ecm_c+prev_ecm_c_completed)
+    line7 = 'Average time per curve, Stage 1: {0:.3f}s, Stage 2: {1:.3f}s'.format(tt_stg1/ecm_s1_completed, tt_stg2/ecm_c_completed)
+    line8 = 'Total runtime = ' + rt
+    line9 = 'No factor was found.'
+
+    my_msg = my_msg + line1 + '\n'
+    my_msg = my_msg + line2 + '\n\n'
+    my_msg = my_msg + line3 + '\n'
+    my_msg = my_msg + line4 + '\n'
+    my_msg = my_msg + line5 + '\n'
+    my_msg = my_msg + line6 + '\n'
+    my_msg = my_msg + line7 + '\n'
+    my_msg = my_msg + line8 + '\n'
+    my_msg = my_msg + line9 + '\n'
+
+    rt = get_runtime(t_total)
+    str_stg1, t_stg1 = get_avg_str(ecm_s1_completed, tt_stg1)
+    str_stg2, t_stg2 = get_avg_str(ecm_c_completed, tt_stg2)
+    write_string_to_log('{0:6d} of {1:6d} | Stg1 {2:s} | Stg2 {3:s} | {4:s} |   0d 00:00:00'
+                         .format(ecm_c_completed, ecm_c+prev_ecm_c_completed, str_stg1, str_stg2, rt))
+
+    write_string_to_log(line9)
+# ################################################
+    if VERBOSE >= v_normal:
+      print('-> *** No factor found.\n')
+#    print('\n---------------------------------------------------------------\n')
+#    print(my_msg)
+#    print('\n---------------------------------------------------------------\n\n')
+    if save_to_file:
+      ecm_job_prefix = ecm_job.split('.')[0]
+      for f in glob.iglob(ecm_job_prefix + '_t*'):
+        cat_f(f, output_file)
+    if email_results:
+      sendemail(from_addr    = em_usr,
+                to_addr_list = em_to,
+                cc_addr_list = em_cc,
+                subject      = '[Ecm.py] Report: All curves complete, no factor found.',
+                message      = my_msg,
+                login        = em_usr,
+                password     = em_pwd,
+                smtpserver   = em_srv)
+
+  #now that we are done with this job, delete associated files...
+  ecm_job_prefix = ecm_job.split('.')[0]
+  if len(ecm_job_prefix) > 0:
+    for f in glob.iglob(ecm_job_prefix + '*'):
+      delete_file(f)
+      job_file_tails.pop(f, None)
+
+  output(' ')
 
-    if factor_found:
-      terminate_ecm_threads()
 
-  first_getsizes = False
+def run_ecm_numbers():
+  '''
+  Work on all the numbers in number_list, including composites enqueued along the way.
 
+  intNumThreads instances of gmp-ecm are kept busy across as many numbers as it takes:
+  numbers we have started get free slots first, then the next number is started.
+  A number is finished when a factor is found (only its own instances are stopped)
+  or when all its curves are done.
+  '''
+  global procs, ecm_events, number_list
+  global ecm_job, factor_found, curves_left, number_procs, number_ret, next_gather, poll_file_delay
+
+  # start each number from the options we were given, not from the last number we looked at
+  base_state = save_number_state()
+  active = [] # saved state of each number we are working on, oldest first
+  next_number = 0
+  ecm_events = Queue()
+
+  while True:
+    # fill any free slots
+    while len(procs) < intNumThreads:
+      state = next((s for s in active if s['ecm_c'] == 0 or s['curves_left'] > 0), None)
+      if state is None:
+        if next_number >= len(number_list):
+          break
+        next_number += 1
+        load_number_state(base_state)
+        if not start_number(number_list[next_number-1]):
+          finish_number()
+          continue
+        state = save_number_state()
+        active.append(state)
+
+      load_number_state(state)
+      start_ecm_instance()
+      state.update(save_number_state())
+
+    if not active:
+      break
 
-def monitor_ecm_threads():
-  global procs, ecm_job, factor_found, ecm_c_completed, tt_stg1, tt_stg2, poll_file_delay
-  global prev_ecm_c_completed, prev_tt_stg1, prev_tt_stg2, ecm_s1_completed, prev_ecm_s1_completed
-  ret = 0
-  running = True
-  first_time = True
-  fin_set = set()
+    # Job files are read as soon as tee_output reports a curve, factor or exit,
+    # otherwise we wake up once a second to update the runtime and eta.
+    events = wait_for_ecm_events(1.0)
+    for state in list(active):
+      mine = [(p, kind) for p, kind in events if p in state['number_procs']]
+      if not mine and time.time() < state['next_gather']:
+        continue
+
+      load_number_state(state)
+      next_gather = time.time() + poll_file_delay
+      for p, kind in mine:
+        if kind == 'exit':
+          number_procs.remove(p)
+          procs.remove(p)
+          number_ret |= p.returncode
 
-  while running:
-    if not first_time:
       gather_work_done(ecm_job)
-      print_work_done()
       if factor_found:
-        terminate_ecm_threads()
-        return 0
-
-      i = 0
-      while i < poll_file_delay:
-        i += 1
-        time.sleep(1.0)
         print_work_done()
-    else:
-      time.sleep(1)
-      first_time = False
-
-    running = False
-    for i, p in enumerate(procs):
-      retc = p.poll()
-      if retc == None:
-        running = True
+        terminate_procs(number_procs)
+        for p in number_procs:
+          procs.remove(p)
+        number_procs = []
+      elif not number_procs and curves_left == 0 and ecm_c != 0:
+        print_work_done()
+        if number_ret != 0:
+          die('\n-> *** Error: unexpected return value: {0:d}'.format(number_ret))
       else:
-        ret |= retc
-        fin_set = fin_set | set((i,))
-  for i in reversed(sorted(list(fin_set))):
-    del procs[i]
-  return ret
+        state.update(save_number_state())
+        continue
+
+      active.remove(state)
+      finish_number()
+
+    # the progress line is for the oldest number we are working on
+    if active:
+      load_number_state(active[0])
+      print_work_done()
+      active[0].update(save_number_state())
 
 
 def update_job_file():
@@ -1097,7 +1510,8 @@ def find_work_done():
 
   job_file_prefix = ecm_job.split('.')[0]
   for f in glob.iglob(job_file_prefix + '_t*'):
-    info, factors_found, (step1_complete, step1_timing), (step2_complete, step2_timing) = parse_job_file(f)
+    state = read_job_file(f)
+    info, factors_found, (step1_complete, step1_timing), (step2_complete, step2_timing) = job_file_summary(state)
     if info[0]:
       factor_data = info[0]
 
@@ -1106,7 +1520,7 @@ def find_work_done():
     prev_ecm_c_completed += step2_complete
     prev_tt_stg2 += step2_timing
 
-    handle_enqueue_composite_factors(factors_found, f)
+    handle_enqueue_composite_factors(factors_found, state['cofactors'])
 
     if save_to_file:
       cat_f(f, output_file)
@@ -1227,11 +1641,11 @@ def get_step2_time(f):
 
 
 def get_out_fin(f):
-  '''this function will return a list of each 'B1:param:sigma' that it finds in an output file'''
+  '''this function will return a set of each 'B1:param:sigma' that it finds in an output file'''
   if not os.path.exists(f):
-    return []
+    return set(), False, ''
 
-  mylist = []
+  myset = set()
   f_found = False # did we find a factor in one of our output files...
   f_info = ''
 
@@ -1266,14 +1680,12 @@ def get_out_fin(f):
         if 'Factor found' in line:
           f_found, f_info = find_factor_info(f)
         if B1 == '0' or sigma == '0': continue
-        fin = B1 + ':' + param + ':' + sigma
-        if fin not in mylist:
-          mylist.append(fin)
+        myset.add(B1 + ':' + param + ':' + sigma)
         B1 = '0'
         param = '0'
         sigma = '0'
 
-  return mylist, f_found, f_info
+  return myset, f_found, f_info
 
 
 def find_factor_info(f):
@@ -1320,11 +1732,85 @@ def get_c_complete(f):
 # [4] Output file name where the GMP-ECM output will be stored (string)
 # [5] The list of resume lines this tread is working on (list of strings)
 # [6] Whether this thread is currently doing resume work (True or False)
-def gather_resume_work_done():
-  global threadList, intNumThreads, files_c, files_t2, files_sizes, ecm_resume_finished_file
+# [7] How many of [5] have been written to the finished file (integer)
+def resume_line_b1(line, p95_b1):
+  '''B1 of a resume line, Prime95 resume lines don't have one so p95_b1 is used'''
+  for entry in line.split(';'):
+    if 'B1=' in entry:
+      return entry.split('=')[-1]
+  return p95_b1
+
+
+def resume_line_key(line, p95_b1):
+  '''
+  'B1:param:sigma' of a resume line, to match the entries from get_out_fin
+  ie, METHOD=ECM; PARAM=1; SIGMA=3697736388; B1=250000; N=<num>; X=...;<snip>  =>  '250000:1:3697736388'
+  A Prime95 resume line (N=0x...; QX=0x...; SIGMA=...) has no B1 so p95_b1 is used
+  '''
+  B1 = p95_b1
+  param = '0'
+  sigma = '0'
+  for entry in line.split(';'):
+    entry = entry.strip()
+    if 'b1=' in entry.lower():
+      B1 = entry.split('=')[1]
+    if 'sigma=' in entry.lower():
+      sigma = entry.split('=')[1]
+    if 'param=' in entry.lower():
+      param = entry.split('=')[1]
+  return B1 + ':' + param + ':' + sigma
+
+
+def start_resume_batch(i, workTodo, batch_size, p95_b1, display = v_normal):
+  '''
+  Start worker i on the next (up to batch_size) lines of workTodo that share a B1.
+  Returns False if workTodo is empty.
+  '''
+  global threadList, ecm_args, ecm_events
+
+  if not workTodo:
+    return False
+
+  B1 = resume_line_b1(workTodo[0], p95_b1)
+  batch = []
+  while workTodo and len(batch) < batch_size and resume_line_b1(workTodo[0], p95_b1) == B1:
+    batch.append(workTodo.popleft())
+
+  with open(threadList[i][3], 'w') as f:
+    for entry in batch:
+      f.write(entry + '\n')
+  threadList[i][5] = batch
+  threadList[i][6] = True
+  threadList[i][7] = 0
+
+  my_ecm_args = ecm_args + ' -resume ' + threadList[i][3] + ' ' + B1
+  threadList[i][1] = run_exe(ECM, my_ecm_args, display = display, log = True,
+                             out_file = threadList[i][4], wait = False, resume = len(batch),
+                             tee = ecm_events)
+  return True
+
+
+def write_resume_finished(i):
+  '''append the resume lines worker i finished since the last call to the finished file'''
+  global threadList, files_c, ecm_resume_finished_file
+
+  done = threadList[i][5][threadList[i][7]:files_c[i]]
+  if done:
+    with open(ecm_resume_finished_file, 'a') as f:
+      f.write(''.join(entry + '\n' for entry in done))
+    threadList[i][7] += len(done)
+
+
+def gather_resume_work_done(events = ()):
+  '''events are (proc, kind) from tee_output since the last call'''
+  global threadList, intNumThreads, files_c, files_t2, ecm_resume_finished_file, job_file_tails
+  global resume_batches_c, resume_batches_t2
 
   any_factor_found = False
   any_factor_info = ''
+  factor_procs = [p for p, kind in events if kind == 'factor']
+  # a proc can exit before tee_output has copied all of its output, so wait for the exit event
+  exited_procs = [p for p, kind in events if kind == 'exit']
 
   for i in range(intNumThreads):
     factor_found = False
@@ -1336,38 +1822,52 @@ def gather_resume_work_done():
 
     if isinstance(threadList[i][1], int):
       retc = threadList[i][1]
+    elif threadList[i][1] in exited_procs:
+      retc = threadList[i][1].returncode
     else:
-      retc = threadList[i][1].poll()
+      retc = None
 
     # TODO(seth): Dedup with parse_job_file
 
     if retc == None:
-      # use file sizes to reduce the number of times we read in the whole file for processing
-      if files_sizes[i] != os.path.getsize(threadList[i][4]):
-        files_sizes[i] = os.path.getsize(threadList[i][4]) #update the file size...
+      # only read what was appended since the last time
+      if tail_job_file(threadList[i][4]):
+        state = job_file_tails[threadList[i][4]]
         # count how many curves are complete in this file...
-        files_c[i] = get_c_complete(threadList[i][4])
+        files_c[i] = resume_lines_done(state)
         # get stage2 runtime for time estimate...
-        files_t2[i] = get_step2_time(threadList[i][4])
+        files_t2[i] = state['step2_timing']
+        # record each resume line as soon as it is done
+        write_resume_finished(i)
+      # don't wait for this instance to finish its other resume lines
+      if threadList[i][1] in factor_procs:
+        factor_found, factor_info = find_factor_info(threadList[i][4])
+        if factor_found:
+          any_factor_found = True
+          any_factor_info = any_factor_info + '\n' + factor_info
     # if the program is done, then we can go ahead and wrap it up...
     else:
       # this thread is done working...
       # we'll post process its results one last time...
       threadList[i][6] = False
-      files_c[i] = get_c_complete(threadList[i][4])
+      tail_job_file(threadList[i][4])
+      state = job_file_tails.pop(threadList[i][4])
+      files_c[i] = resume_lines_done(state)
       # get stage2 runtime for time estimate
-      files_t2[i] = get_step2_time(threadList[i][4])
-      # write all of our resume lines (that we finished working on) to the finished file...
+      files_t2[i] = state['step2_timing']
+      # write the rest of our resume lines (that we finished working on) to the finished file...
       # the total number of lines we finished working on is in files_c[i]...
-      fin_out = ''
-      for entry in threadList[i][5][:files_c[i]]:
-        fin_out = fin_out + entry + '\n'
-      with open(ecm_resume_finished_file, 'a') as f:
-          f.write(fin_out)
+      write_resume_finished(i)
       # Now that we've written the completed lines out to a file, we'll empty out the worktodo list
       # so nobody else also tries to write our completed work out to file...
       threadList[i][5] = []
+      threadList[i][7] = 0
       threadList[i][2] = retc
+      # this batch is done, the next batch of this worker starts counting from zero
+      resume_batches_c += files_c[i]
+      resume_batches_t2 += files_t2[i]
+      files_c[i] = 0
+      files_t2[i] = 0.0
 
 # Exit statuses returned by GMP-ECM:
 # 0      Normal program termination, no factor found
@@ -1406,6 +1906,14 @@ def gather_resume_work_done():
   # If we have found a factor, then we are done and need to save our output (if asked to do so)
   # and delete all of our temporary files
   if any_factor_found:
+    # the other instances are stopped mid batch, record the resume lines they already finished so they aren't rerun
+    for i in range(intNumThreads):
+      if threadList[i][6] and os.path.exists(threadList[i][4]):
+        tail_job_file(threadList[i][4])
+        files_c[i] = resume_lines_done(job_file_tails[threadList[i][4]])
+        files_t2[i] = job_file_tails[threadList[i][4]]['step2_timing']
+        write_resume_finished(i)
+
     for worker in threadList:
       if not isinstance(worker[1], (int, str)):
         if worker[1].poll() == None:
@@ -1423,6 +1931,7 @@ def gather_resume_work_done():
       # when we're done with them, delete the temporary input and output files
       delete_file(threadList[i][3])
       delete_file(threadList[i][4])
+      job_file_tails.pop(threadList[i][4], None)
 
 
   return any_factor_found, any_factor_info
@@ -1430,18 +1939,18 @@ def gather_resume_work_done():
 
 def print_resume_work_done():
   global intNumThreads, files_c, files_t2, job_start, num_resume_lines, need_using_line
-  global next_log_interval, log_interval_seconds, prev_c_completed
+  global next_log_interval, log_interval_seconds, prev_c_completed, resume_batches_c, resume_batches_t2
 #____________________________________________________________________________
 # Curves Complete |   Average seconds/curve   |    Runtime    |      ETA
 #-----------------|---------------------------|---------------|--------------
 #  2114 of   6000 | Stg1  2983s | Stg2 693.5s |  22d 12:27:08 |  41d 08:37:51
 
-  cur_c_completed = 0
+  cur_c_completed = resume_batches_c
   for i in range(intNumThreads):
     cur_c_completed += files_c[i]
   tot_c_completed = prev_c_completed + cur_c_completed
 
-  t2_time = 0.0
+  t2_time = resume_batches_t2
   for i in range(intNumThreads):
     t2_time += files_t2[i]
 
@@ -1469,11 +1978,13 @@ def print_resume_work_done():
 #      - If this happens, we will print out a notice to the user (if VERBOSE >= v_normal) so they know what is going on
 # 3) We will use the B1 value in the resume file, and not resume with higher values of B1
 # 4) We will let gmp-ecm determine which B2 value to use, which can be affected by "-maxmem" and "-k"
-# 5) We will try to split up the resume work evenly between the threads.
-#     - We will put total/num_threads resume lines into each file, and total%num_threads files will each get one extra line.
-#      At the end of a job or when restarting a job, we will write any completed resume lines out to a "finished file"
+# 5) We will hand out the resume work in small batches so all threads stay busy until the end.
+#     - Each instance of gmp-ecm gets resume_batch_size lines (that share a B1) from a shared list,
+#      when it finishes that batch a new instance is started on the next batch.
+#      As each resume line is completed we will write it out to a "finished file"
 #      This "finished file" will be used to help us keep track of work done, in case we are interrupted and need to (re)resume later
-#      We will query the output files once every poll_file_delay seconds.
+#      We will query the output files whenever GMP-ECM finishes a curve, finds a factor or exits
+#      and at least once every poll_file_delay seconds.
 #    resume_job_<filename>_inp_t00.txt # input resume file for use by gmp-ecm in thread 0
 #    resume_job_<filename>_inp_t01.txt # input resume file for use by gmp-ecm in thread 1
 #    ...etc...
@@ -1489,7 +2000,8 @@ def run_ecm_resume_job(p95_b1):
   global intNumThreads, ecm_args, ecm_resume_file, save_to_file, output_file, poll_file_delay
   global em_usr, em_to, em_cc, em_usr, em_pwd, em_srv, next_log_interval, log_interval_seconds
   global need_using_line, need_version_info, using_line, version_info, threadList, prev_c_completed
-  global files_c, files_t2, files_sizes, num_resume_lines, tot_c_completed, job_start, ecm_resume_finished_file
+  global files_c, files_t2, num_resume_lines, tot_c_completed, job_start, ecm_resume_finished_file, ecm_events
+  global resume_batches_c, resume_batches_t2
 
 
   job_start = time.time()
@@ -1515,30 +2027,26 @@ def run_ecm_resume_job(p95_b1):
 
   all_resume_lines = []
   all_resume_lines1 = []
-  all_finished_lines = []
-  all_finished_lines1 = []
+  all_finished_lines = set()
   num_resume_lines = 0
   num_resume_lines1 = 0
   num_finished_lines = 0
   prev_c_completed = 0
 
-  # read in all the lines from the resume file...
+  # read in all the lines from the resume file, without any blank/empty lines...
   with open(ecm_resume_file, 'r') as f:
-    all_resume_lines1 = f.readlines()
-
-  # remove any blank/empty lines...
-  for i in reversed(range(len(all_resume_lines1))):
-    if all_resume_lines1[i].strip() == '':
-      del all_resume_lines1[i]
+    all_resume_lines1 = [line for line in f if line.strip() != '']
 
-  # make sure each line in all_resume_lines is unique...
+  # make sure each line in all_resume_lines is unique (checked with a set, resume files can have 100k+ lines)...
+  seen_lines = set()
   for line in all_resume_lines1:
     line = line.strip()
     if len(line) == 0: continue
     # Prime95 resume files might have extra lines that are for information purposes only.
     # We will skip those lines and not add them to our list of work to do...
     if '[' in line or 'We4:' in line: continue
-    if line not in all_resume_lines:
+    if line not in seen_lines:
+      seen_lines.add(line)
       all_resume_lines.append(line)
   num_resume_lines = len(all_resume_lines) # total number of unique lines
   num_resume_lines1 = len(all_resume_lines1) # total number of lines
@@ -1567,7 +2075,7 @@ def run_ecm_resume_job(p95_b1):
   for f in glob.iglob('resume_job_' + fname + '_inp_t*.txt'):
     delete_file(f)
 
-  output_finished = []
+  output_finished = set()
 
   # Gather up the work done in the output files from this resume job, and then delete the old output files...
   for f in glob.iglob('resume_job_' + fname + '_out_t*.txt'):
@@ -1579,9 +2087,7 @@ def run_ecm_resume_job(p95_b1):
     # we will later use these values to try to match up to the lines in our resume file...
     # also check to see if a factor was found in this output file...
     out_fin, factor_found, factor_info = get_out_fin(f)
-    for entry in out_fin:
-      if entry not in output_finished:
-        output_finished.append(entry)
+    output_finished |= out_fin
 
     tot_c_completed += get_c_complete(f)
     if factor_found:
@@ -1594,60 +2100,40 @@ def run_ecm_resume_job(p95_b1):
   ecm_resume_finished_file = 'resume_job_' + fname + '_finished.txt'
   if os.path.exists(ecm_resume_finished_file):
     with open(ecm_resume_finished_file, 'r') as f:
-      all_finished_lines1 = f.readlines()
-    # make sure each line in all_finished_lines is unique...
-    for line in all_finished_lines1:
-      line = line.strip()
-      if len(line) == 0: continue
-      if line not in all_finished_lines:
-        all_finished_lines.append(line)
+      # a set makes sure each line in all_finished_lines is unique...
+      for line in f:
+        line = line.strip()
+        if len(line) == 0: continue
+        all_finished_lines.add(line)
     num_finished_lines = len(all_finished_lines)
 
-  # if our output_finished list contains entries not in our all_finished_lines,
+  # if our output_finished set contains entries not in our all_finished_lines,
   # then we will need to add those entries to the ecm_resume_finished_file
+  # first, index our resume lines by 'B1:param:sigma' (see resume_line_key) so each entry is a single lookup,
+  # a key can belong to more than one resume line so each key maps to a list of lines in file order
+  # if entry = '250000:1:3697736388' and
+  # resume line = METHOD=ECM; PARAM=1; SIGMA=3697736388; B1=250000; N=<num>; X=...;<snip>
+  # then we will declare that we have found a match and
+  # 1) if that line is not in our all_finished_lines, we'll add it to the ecm_resume_finished_file
+  # 2) and then we'll add it to our all_finished_lines
+  # =====
+  # Note: No B1 information is in a Prime95 resume line, so we use p95_b1 which should be passed in via the
+  # command line when this script is called
+  resume_index = {}
+  for rline in all_resume_lines:
+    resume_index.setdefault(resume_line_key(rline, p95_b1), []).append(rline)
+
+  fin_out = ''
   for entry in output_finished:
-    # first, find the resume line that corresponds to our entry, each entry looks like: 'B1:param:sigma'
-    # which can be matched to a resume line like so:  if entry = '250000:1:3697736388'
-    # and if resume line = METHOD=ECM; PARAM=1; SIGMA=3697736388; B1=250000; N=<num>; X=...;<snip>
-    # then we will declare that we have found a match and
-    # 1) if that line is not in our all_finished_lines, we'll add it to the ecm_resume_finished_file
-    # 2) and then we'll add it to our all_finished_lines
-    # =====
-    # Note: A Prime95 resume line can/will look like:
-    # N=0x...; QX=0x...; SIGMA=...
-    # No B1 information is passed in, so we use p95_b1 which should be passed in via the command line when this script is called
-    for rline in all_resume_lines:
-      rs = rline.strip().split(';')
-      B1 = '0'
-      param = '0'
-      sigma = '0'
-      found_b1 = False
-      for re in rs:
-        re = re.strip()
-        if 'b1=' in re.lower():
-          try:
-            B1 = re.split('=')[1]
-            found_b1 = True
-          except:
-            pass
-        if 'sigma=' in re.lower():
-          try: sigma = re.split('=')[1]
-          except: pass
-        if 'param=' in re.lower():
-          try: param = re.split('=')[1]
-          except: pass
-      if not found_b1:
-        B1 = p95_b1
-      rline_entry = B1 + ':' + param + ':' + sigma
-      # if we have found a match, now we have to see if this resume line is in our all_finished_lines
-      if entry == rline_entry:
-        if rline not in all_finished_lines:
-          # write it out to file...
-          with open(ecm_resume_finished_file, 'a') as f:
-            f.write(rline + '\n')
-          # append it to our all_finished_lines list...
-          all_finished_lines.append(rline)
-          break
+    # the first matching resume line that isn't in our all_finished_lines
+    for rline in resume_index.get(entry, []):
+      if rline not in all_finished_lines:
+        fin_out = fin_out + rline + '\n'
+        all_finished_lines.add(rline)
+        break
+  if len(fin_out) > 0:
+    with open(ecm_resume_finished_file, 'a') as f:
+      f.write(fin_out)
 
 
 # ################################################
@@ -1696,12 +2182,9 @@ def run_ecm_resume_job(p95_b1):
 
 
   # Now, move each of our resume lines into our workTodo list, unless a resume line is in our all_finished_lines...
-  workTodo = []
-  num_workTodo = 0
-  for rline in all_resume_lines:
-    if rline not in all_finished_lines:
-      workTodo.append(rline)
+  workTodo = [rline for rline in all_resume_lines if rline not in all_finished_lines]
   num_workTodo = len(workTodo)
+  workTodo = collections.deque(workTodo)
 
   if num_workTodo == 0:
     die('-> *** All resume lines have already been finished.  Quitting.')
@@ -1724,58 +2207,49 @@ def run_ecm_resume_job(p95_b1):
   # [4] Output file name where the GMP-ECM output will be stored (string)
   # [5] The list of resume lines this tread is working on (list of strings)
   # [6] Whether this thread is currently doing resume work (True or False)
-  threadList = [[i, '', 0, '', '', [], False] for i in range(intNumThreads)]
+  # [7] How many of [5] have been written to the finished file (integer)
+  threadList = [[i, '', 0, '', '', [], False, 0] for i in range(intNumThreads)]
+  ecm_events = Queue()
+  resume_batches_c = 0
+  resume_batches_t2 = 0.0
 
+  batch_size = resume_batch_size
+  if batch_size <= 0:
+    batch_size = max(1, num_workTodo // (intNumThreads * 10))
 
-  # prepare and then start each of our gmp-ecm instances...
-  resumeIndex = 0
-  batch = num_workTodo//intNumThreads
-  batch_remain = num_workTodo%intNumThreads
+  # prepare and then start each of our gmp-ecm instances on its first batch...
   for i in range(intNumThreads):
-    start = resumeIndex
-    end = resumeIndex+batch
-    if i < batch_remain: end += 1
-    resumeIndex = end
     threadList[i][3] = 'resume_job_' + fname + '_inp_t' + str(threadList[i][0]).zfill(2) + '.txt'
     threadList[i][4] = 'resume_job_' + fname + '_out_t' + str(threadList[i][0]).zfill(2) + '.txt'
-    with open(threadList[i][3], 'w') as f:
-      for j in range(start, end):
-        threadList[i][5].append(workTodo[j])
-        f.write(workTodo[j] + '\n')
-    if len(threadList[i][5]) > 0:
-      threadList[i][6] = True
-      # Grab the B1 value from the first entry in our work todo list...
-      wSplit = threadList[i][5][0].split(';')
-      found_b1 = False
-      for entry in wSplit:
-        if 'B1=' in entry:
-          B1 = entry.split('=')[-1]
-          found_b1 = True
-      if not found_b1:
-        B1 = p95_b1
-      my_ecm_args = ecm_args + ' -resume ' + threadList[i][3] + ' ' + B1
-      threadList[i][1] = run_exe(ECM, my_ecm_args, display = v_normal, log = True,
-                                 out_file = threadList[i][4], wait = False, resume = len(threadList[i][5]))
+    if start_resume_batch(i, workTodo, batch_size, p95_b1):
       # try not to start "too many" jobs at once.  sleep for a bit and then start another.
       time.sleep(0.1)
 
   ret = 0
   running = True
-  first_time = True
+  next_gather = 0
   files_c = [0 for i in range(intNumThreads)] # total amount of curves completed in each of our files...
   files_t2 = [0 for i in range(intNumThreads)] # total amount of Step 2 time in each of our files...
-  files_sizes = [0 for i in range(intNumThreads)] # size each of our files, used to detect when there is a change...
 
+  # Output files are read as soon as tee_output reports a curve, factor or exit,
+  # otherwise we wake up once a second to update the runtime and eta.
   while running:
-    if first_time:
-      time.sleep(1)
-      first_time = False
+    events = wait_for_ecm_events(1.0)
+    if not events and time.time() < next_gather:
+      print_resume_work_done()
       continue
+    next_gather = time.time() + poll_file_delay
 
     if need_version_info: get_version_info(threadList[0][4])
     if need_using_line:   get_using_line(threadList[0][4])
 
-    factor_found, factor_info = gather_resume_work_done()
+    factor_found, factor_info = gather_resume_work_done(events)
+
+    # threads that finished their batch take the next one (only logged, so the progress line isn't broken up)
+    if not factor_found:
+      for i in range(intNumThreads):
+        if not threadList[i][6]:
+          start_resume_batch(i, workTodo, batch_size, p95_b1, display = v_quiet)
     print_resume_work_done()
 
     running = False
@@ -1786,30 +2260,17 @@ def run_ecm_resume_job(p95_b1):
     if factor_found or not running:
       break
 
-    i = 0
-    while i < poll_file_delay:
-      i += 1
-      time.sleep(1.0)
-      print_resume_work_done()
-
 
 
-  cur_c_completed = 0
+  cur_c_completed = resume_batches_c
   for i in range(intNumThreads):
     cur_c_completed += files_c[i]
   tot_c_completed = prev_c_completed + cur_c_completed
 
 
-  # write all of our completed lines out to the completed file...
-  # make sure the entries we want to write out, aren't already in the finished file...
-  fin_output = ''
+  # write any completed lines that haven't been written out to the completed file...
   for i in range(intNumThreads):
-    for entry in threadList[i][5][:files_c[i]]:
-      if entry not in all_finished_lines:
-        fin_output = fin_output + entry + '\n'
-  if len(fin_output) > 0:
-    with open(ecm_resume_finished_file, 'a') as f:
-      f.write(fin_output)
+    write_resume_finished(i)
 
 
   print('\n')
@@ -2438,216 +2899,4 @@ atexit.register(terminate_ecm_threads)
 
 parse_ecm_options(sys.argv, set_args = True, first = True)
 
-for ecm_n in number_list:
-
-  factor_found = False
-  factor_value = ''
-  factor_data = ''
-  job_complete = False
-  ecm_c_has_changed = False
-  prev_ecm_c_completed = 0
-  prev_tt_stg1 = 0
-  prev_tt_stg2 = 0
-  prev_ecm_s1_completed = 0
-  file_sizes.clear()
-  ecm_c_completed_per_file.clear()
-  ecm_s1_completed_per_file.clear()
-  tt_stg1_per_file.clear()
-  tt_stg2_per_file.clear()
-  first_getsizes = True
-  need_using_line = True
-  need_version_info = True
-  my_msg = ''
-  continue_composite = 0
-  tmp_info = []
-
-  # check to see if this ecm_n is a job we should continue...
-  if ':' in ecm_n:
-    # Searh "find_one_factor_and_stop", happens when we found one factor but are continuning (and have a count of curves)
-    continue_composite = 1
-    tmp_info = ecm_n.split(':')
-    ecm_n = tmp_info[0]
-
-  my_str1 = '->============================================================================='
-  my_str2 = '-> Working on number: {0:s} ({1:d} digits)'.format(abbreviate(ecm_n), num_digits(ecm_n))
-  write_string_to_log(my_str1)
-  write_string_to_log(my_str2)
-  if VERBOSE >= v_normal:
-    print(my_str1)
-    print(my_str2)
-
-  if continue_composite == 1:
-    # XXX: Seth: I believe the point is just to update -c?
-    parse_ecm_options(ecm_args.split(), new_curves = int(tmp_info[1]), quiet = True)
-    create_job_file()
-    intResume = 1
-  elif intResume == 1:
-    output('-> Trying to resume job in file: {0:s}'.format(resume_file))
-    find_work_done()
-  elif AUTORESUME:
-    # Try to find out if we have already done work on this job
-    # If so, we'll pick up where we left off
-    # If not, we'll start a new job
-    parse_ecm_options(ecm_args.split(), quiet = True)
-    if find_job_file():
-      find_work_done()
-    else:
-      create_job_file()
-  else:
-    # If we are not manually or automatically resuming,
-    # then just create a job file and start working on it.
-    parse_ecm_options(ecm_args.split(), quiet = True)
-    create_job_file()
-
-  if not factor_found and not job_complete:
-    my_str = '-> Currently working on: ' + ecm_job
-    if VERBOSE >= v_normal:
-      print(my_str)
-    write_string_to_log(my_str)
-    job_start = time.time()
-    if intResume == 0:
-      parse_ecm_options(ecm_args.split())
-    start_ecm_threads()
-    ret = monitor_ecm_threads()
-    if not factor_found:
-      gather_work_done(ecm_job)
-      print_work_done()
-
-    if ret != 0 and not factor_found:
-      die('\n-> *** Error: unexpected return value: {0:d}'.format(ret))
-
-  print('\n')
-
-  t_total = time.time() - job_start
-  if factor_found:
-# ################################################
-    line1 = 'Computer: ' + socket.gethostname()
-    line2 = 'Report Time: ' + time.strftime('%Y/%m/%d %H:%M:%S UTC', time.gmtime())
-    line3 = '{0:s}'.format(version_info)
-    line4 = 'Input number is {0:s} ({1:d} digits)'.format(ecm_n, num_digits(ecm_n))
-    line5 = 'Run {0:d} out of {1:d}:'.format(ecm_c_completed, ecm_c+prev_ecm_c_completed)
-    line6 = '{0:s}'.format(factor_data)
-    line7 = '{0:s}'.format(time_str)
-    line8 = '{0:s}'.format(factor_value)
-
-    my_msg = my_msg + line1 + '\n'
-    my_msg = my_msg + line2 + '\n\n'
-    my_msg = my_msg + line3 + '\n'
-    my_msg = my_msg + line4 + '\n'
-    my_msg = my_msg + line5 + '\n'
-    my_msg = my_msg + line6 + '\n'
-    my_msg = my_msg + line7 + '\n'
-    my_msg = my_msg + line8 + '\n'
-
-    rt = get_runtime(t_total)
-    str_stg1, t_stg1 = get_avg_str(ecm_s1_completed, tt_stg1)
-    str_stg2, t_stg2 = get_avg_str(ecm_c_completed, tt_stg2)
-    write_string_to_log('{0:6d} of {1:6d} | Stg1 {2:s} | Stg2 {3:s} | {4:s} |   0d 00:00:00'
-                         .format(ecm_c_completed, ecm_c+prev_ecm_c_completed, str_stg1, str_stg2, rt))
-
-    write_string_to_log(line3)
-    write_string_to_log(line4)
-    write_string_to_log(line5)
-    write_string_to_log(line6)
-    write_string_to_log(line7)
-    write_string_to_log(line8)
-# ################################################
-    if VERBOSE >= v_normal:
-      print('Run {0:d} out of {1:d}:'.format(ecm_c_completed, ecm_c+prev_ecm_c_completed))
-      print('{0:s}'.format(factor_data))
-      print('{0:s}'.format(time_str))
-      print('{0:s}'.format(factor_value))
-#    print('\n---------------------------------------------------------------\n')
-#    print(my_msg)
-#    print('\n---------------------------------------------------------------\n\n')
-    if save_to_file:
-      with open(output_file, 'a') as out_f:
-        out_f.write(my_msg)
-    if email_results:
-      sendemail(from_addr    = em_usr,
-                to_addr_list = em_to,
-                cc_addr_list = em_cc,
-                subject      = '[Ecm.py] Report: Factor found!',
-                message      = my_msg,
-                login        = em_usr,
-                password     = em_pwd,
-                smtpserver   = em_srv)
-
-    # if we were asked to keep working, make sure we have some composites to keep working with,
-    # if so, then calculate the new number of curves to run on those numbers, and then append those
-    # composite_num:new_curve to our number_list so we can finish the remaining number of curves on them...
-    if find_one_factor_and_stop == 0 and remaining_composites != '':
-      new_curves = ecm_c + prev_ecm_c_completed - ecm_c_completed
-      for entry in remaining_composites.split('~'):
-        if entry != '':
-          print(' ')
-          print('-> * Notice: Enqueuing composite number {0:s}'.format(abbreviate(entry, length = 40)))
-          print('-> * Notice: Will run the remaining {0:d} curves on it'.format(new_curves))
-          number_list.append(entry + ':' + str(new_curves))
-      remaining_composites = ''
-      new_curves = 0
-  else:
-# ################################################
-    print("factor_data:", factor_data)
-    ud = factor_data.split(',')
-    b1b2_info = '{0:s},{1:s},{2:s}, {3:d} thread{4:s}'.format(ud[0],ud[1],ud[2],actual_num_threads, '' if (actual_num_threads == 1) else 's')
-    zd = '{0:.0f}'.format(math.floor(t_total/86400.0)).rjust(3) + 'd '
-    zh = '{0:.0f}'.format(math.floor((t_total%86400)/3600.0)).zfill(2) + 'h '
-    zm = '{0:.0f}'.format(math.floor((t_total%3600)/60.0)).zfill(2) + 'm '
-    zs = '{0:.0f}'.format(math.floor(t_total%60.0)).zfill(2) + 's'
-    rt = zd + zh + zm + zs
-
-    line1 = 'Computer: ' + socket.gethostname()
-    line2 = 'Report Time: ' + time.strftime('%Y/%m/%d %H:%M:%S UTC', time.gmtime())
-    line3 = '{0:s}'.format(version_info)
-    line4 = 'Input number is {0:s} ({1:d} digits)'.format(ecm_n, num_digits(ecm_n))
-    line5 = b1b2_info
-    line6 = 'Finished {0:d} of {1:d} curves'.format(ecm_c_completed, ecm_c+prev_ecm_c_completed)
-    line7 = 'Average time per curve, Stage 1: {0:.3f}s, Stage 2: {1:.3f}s'.format(tt_stg1/ecm_s1_completed, tt_stg2/ecm_c_completed)
-    line8 = 'Total runtime = ' + rt
-    line9 = 'No factor was found.'
-
-    my_msg = my_msg + line1 + '\n'
-    my_msg = my_msg + line2 + '\n\n'
-    my_msg = my_msg + line3 + '\n'
-    my_msg = my_msg + line4 + '\n'
-    my_msg = my_msg + line5 + '\n'
-    my_msg = my_msg + line6 + '\n'
-    my_msg = my_msg + line7 + '\n'
-    my_msg = my_msg + line8 + '\n'
-    my_msg = my_msg + line9 + '\n'
-
-    rt = get_runtime(t_total)
-    str_stg1, t_stg1 = get_avg_str(ecm_s1_completed, tt_stg1)
-    str_stg2, t_stg2 = get_avg_str(ecm_c_completed, tt_stg2)
-    write_string_to_log('{0:6d} of {1:6d} | Stg1 {2:s} | Stg2 {3:s} | {4:s} |   0d 00:00:00'
-                         .format(ecm_c_completed, ecm_c+prev_ecm_c_completed, str_stg1, str_stg2, rt))
-
-    write_string_to_log(line9)
-# ################################################
-    if VERBOSE >= v_normal:
-      print('-> *** No factor found.\n')
-#    print('\n---------------------------------------------------------------\n')
-#    print(my_msg)
-#    print('\n---------------------------------------------------------------\n\n')
-    if save_to_file:
-      ecm_job_prefix = ecm_job.split('.')[0]
-      for f in glob.iglob(ecm_job_prefix + '_t*'):
-        cat_f(f, output_file)
-    if email_results:
-      sendemail(from_addr    = em_usr,
-                to_addr_list = em_to,
-                cc_addr_list = em_cc,
-                subject      = '[Ecm.py] Report: All curves complete, no factor found.',
-                message      = my_msg,
-                login        = em_usr,
-                password     = em_pwd,
-                smtpserver   = em_srv)
-
-  #now that we are done with this job, delete associated files...
-  ecm_job_prefix = ecm_job.split('.')[0]
-  if len(ecm_job_prefix) > 0:
-    for f in glob.iglob(ecm_job_prefix + '*'):
-      delete_file(f)
-
-  output(' ')
+run_ecm_numbers()
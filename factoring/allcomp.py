@@ -0,0 +1,207 @@
+"""
+Load allcomp.txt from https://stdkmd.net/nrr/allcomp.txt
+
+Parsing the csv (and int() of every CompositeNumber) is slow so a binary
+snapshot of each allcomp file is saved in .allcomp_cache/<sha256>.bin
+next to it. Later loads mmap the snapshot and only decode rows when used.
+
+Snapshot format (all lengths little endian)
+    MAGIC
+    u32 length + json list of csv fieldnames
+    u32 row count
+    per row:
+        u16 length + CompositeNumber as bytes
+        per other field: u16 length + utf-8 value
+
+diff_allcomp() compares two versions of allcomp.txt keyed by N, then Label_N.
+"""
+
+import collections
+import collections.abc
+import csv
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+
+MAGIC = b"ALLCOMP1"
+CACHE_DIR = ".allcomp_cache"
+NUMBER_KEY = "CompositeNumber"
+LABEL_KEY = '#"Label"'
+
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+
+
+class AllcompLookup(collections.abc.Mapping):
+    """Read only {n: row} backed by a snapshot, rows are decoded on first access."""
+
+    def __init__(self, mm, fields, offsets):
+        self._mm = mm
+        self._fields = fields
+        self._offsets = offsets
+        self._rows = {}
+
+    def __getitem__(self, n):
+        row = self._rows.get(n)
+        if row is None:
+            row = self._decode_row(n, self._offsets[n])
+            self._rows[n] = row
+        return row
+
+    def __contains__(self, n):
+        return n in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _decode_row(self, n, offset):
+        mm = self._mm
+        row = {}
+        for field in self._fields:
+            if field == NUMBER_KEY:
+                row[field] = str(n)
+                continue
+            length, = U16.unpack_from(mm, offset)
+            offset += U16.size
+            row[field] = mm[offset:offset + length].decode()
+            offset += length
+        return row
+
+
+def _write_snapshot(fn, snapshot_fn):
+    with open(fn) as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        fields = reader.fieldnames
+    assert NUMBER_KEY in fields, fields
+
+    parts = [MAGIC]
+    header = json.dumps(fields).encode()
+    parts.append(U32.pack(len(header)))
+    parts.append(header)
+    parts.append(U32.pack(len(rows)))
+    for row in rows:
+        n = int(row[NUMBER_KEY])
+        n_bytes = n.to_bytes((n.bit_length() + 7) // 8, "little")
+        parts.append(U16.pack(len(n_bytes)))
+        parts.append(n_bytes)
+        for field in fields:
+            if field == NUMBER_KEY:
+                continue
+            value = (row[field] or "").encode()
+            parts.append(U16.pack(len(value)))
+            parts.append(value)
+
+    os.makedirs(os.path.dirname(snapshot_fn), exist_ok=True)
+    temp_fn = snapshot_fn + ".tmp"
+    with open(temp_fn, "wb") as f:
+        f.write(b"".join(parts))
+    os.replace(temp_fn, snapshot_fn)
+
+
+def _load_snapshot(snapshot_fn):
+    with open(snapshot_fn, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    assert mm[:len(MAGIC)] == MAGIC, snapshot_fn
+    offset = len(MAGIC)
+    length, = U32.unpack_from(mm, offset)
+    offset += U32.size
+    fields = json.loads(mm[offset:offset + length])
+    offset += length
+    count, = U32.unpack_from(mm, offset)
+    offset += U32.size
+
+    other_fields = len(fields) - 1
+    numbers = []
+    offsets = {}
+    for _ in range(count):
+        length, = U16.unpack_from(mm, offset)
+        offset += U16.size
+        n = int.from_bytes(mm[offset:offset + length], "little")
+        offset += length
+
+        numbers.append(n)
+        offsets[n] = offset
+        # Skip over the other fields
+        for _ in range(other_fields):
+            length, = U16.unpack_from(mm, offset)
+            offset += U16.size + length
+
+    assert offset == len(mm), (snapshot_fn, offset, len(mm))
+    return numbers, AllcompLookup(mm, fields, offsets)
+
+
+def snapshot_path(fn):
+    """Path of the binary snapshot for the current contents of fn."""
+    with open(fn, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return os.path.join(os.path.dirname(fn), CACHE_DIR, f"{digest}.bin")
+
+
+def load_allcomp(fn):
+    """Returns sorted list of composites and {n: row} lookup."""
+    snapshot_fn = snapshot_path(fn)
+    if not os.path.exists(snapshot_fn):
+        _write_snapshot(fn, snapshot_fn)
+
+    numbers, lookup = _load_snapshot(snapshot_fn)
+    numbers.sort()
+    assert len(numbers) > 25000, len(numbers)
+    return numbers, lookup
+
+
+def row_label(row):
+    """Unique key for a row e.g. "94447_297"."""
+    return row[LABEL_KEY].replace('"', '') + "_" + row["N"]
+
+
+# kind is one of
+#   "added"     label only in new
+#   "removed"   label only in old (completely factored)
+#   "unchanged" same composite in both (label is None)
+#   "shrank"    new = old / factor
+#   "changed"   composite changed but new doesn't divide old
+AllcompChange = collections.namedtuple("AllcompChange", ["kind", "label", "old", "new", "factor"])
+
+
+def diff_allcomp(old_lookup, new_lookup):
+    """
+    Stream AllcompChange records in one pass over both versions.
+
+    Composites in both versions are "unchanged" and are matched by N without
+    decoding their rows (label is None), these come first in N order. Only
+    rows added or removed by N are decoded and merged by label.
+    """
+    common = old_lookup.keys() & new_lookup.keys()
+    for n in sorted(common):
+        yield AllcompChange("unchanged", None, n, n, None)
+
+    old = iter(sorted((row_label(old_lookup[n]), n) for n in old_lookup if n not in common))
+    new = iter(sorted((row_label(new_lookup[n]), n) for n in new_lookup if n not in common))
+
+    a = next(old, None)
+    b = next(new, None)
+    while a or b:
+        if b is None or (a and a[0] < b[0]):
+            yield AllcompChange("removed", a[0], a[1], None, None)
+            a = next(old, None)
+        elif a is None or b[0] < a[0]:
+            yield AllcompChange("added", b[0], None, b[1], None)
+            b = next(new, None)
+        else:
+            label, old_n = a
+            new_n = b[1]
+            factor, mod = divmod(old_n, new_n)
+            if mod == 0:
+                yield AllcompChange("shrank", label, old_n, new_n, factor)
+            else:
+                yield AllcompChange("changed", label, old_n, new_n, None)
+            a = next(old, None)
+            b = next(new, None)
@@ -0,0 +1,64 @@
+"""
+Plan GPU stage 1 extension steps for residuals at different B1.
+
+A CGBN resume batch needs every residual at the same B1. Each B1 level is
+extended to a higher level (where it merges with those residuals) or directly
+to the target. Extending from B1=a to B1=b only costs the range b - a, merging
+saves per batch overhead and partial launches (see gpu_cost.py).
+
+    seconds, parents = plan_extensions(
+        {10**9: {1280: 5000}, 4 * 10**9: {1280: 20000}}, 10**10, cost_model)
+"""
+
+import itertools
+
+
+# Try every parent assignment with at most this many levels
+MAX_BRUTE_FORCE_LEVELS = 7
+
+
+def step_seconds(counts, cost_model, start_B1, end_B1, batch_seconds=None):
+    """Predicted seconds to extend counts ({kernel: count}) from start_B1 to end_B1."""
+    return sum(
+        cost_model.seconds(count, kernel, end_B1 - start_B1, batch_seconds)
+        for kernel, count in counts.items() if count)
+
+
+def _plan_seconds(levels, counts, parents, cost_model, batch_seconds):
+    """Total seconds when levels[i] is extended to parents[i] (a B1)."""
+    merged = {B1: dict(counts[B1]) for B1 in levels}
+    total = 0
+    for B1, parent in zip(levels, parents):
+        total += step_seconds(merged[B1], cost_model, B1, parent, batch_seconds)
+        if parent in merged:
+            for kernel, count in merged[B1].items():
+                merged[parent][kernel] = merged[parent].get(kernel, 0) + count
+    return total
+
+
+def plan_extensions(counts, target_B1, cost_model, batch_seconds=None):
+    """
+    Find the cheapest parent for every B1 level.
+
+    counts is {B1: {kernel: count}} with every B1 < target_B1.
+    Returns (seconds, {B1: parent_B1}).
+
+    With more than MAX_BRUTE_FORCE_LEVELS levels only extending every level to
+    the next one (a chain) or directly to the target is considered.
+    """
+    levels = sorted(counts)
+    assert levels and levels[-1] < target_B1, (levels, target_B1)
+
+    choices = [levels[i+1:] + [target_B1] for i in range(len(levels))]
+    if len(levels) <= MAX_BRUTE_FORCE_LEVELS:
+        options = itertools.product(*choices)
+    else:
+        options = [
+            [c[0] for c in choices],
+            [target_B1] * len(levels),
+        ]
+
+    best = min(
+        (_plan_seconds(levels, counts, parents, cost_model, batch_seconds), parents)
+        for parents in options)
+    return best[0], dict(zip(levels, best[1]))
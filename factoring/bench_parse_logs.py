@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Benchmark streaming log parsing from process_ecm_logs.py
+
+Writes a synthetic GMP-ECM P-1 log of --size MB (if it doesn't exist) then
+reports lines/sec and peak RSS while parsing it.
+
+    $ python bench_parse_logs.py --size 4096
+"""
+
+import argparse
+import os
+import random
+import resource
+import time
+
+from collections import Counter
+
+import process_ecm_logs
+
+
+RUN = """GMP-ECM 7.0.6-dev [configured with GMP 6.3.0, --enable-asm-redc, --enable-gpu, --enable-openmp] [P-1]
+Resuming P-1 residue saved by four with GPU based P-1 curve on Mon Feb  2 10:11:12 2026
+Input number is {n} ({digits} digits)
+Using B1=10000000000-10000000000, B2=13412040301838880, polynomial x^1, x0=12
+Step 1 took 0ms
+Step 2 took 123456ms
+"""
+
+FACTOR = """GMP-ECM 7.0.6-dev [configured with GMP 6.3.0, --enable-asm-redc, --enable-gpu, --enable-openmp] [P-1]
+Resuming P-1 residue saved by four with GPU based P-1 curve on Mon Feb  2 10:11:12 2026
+Input number is {n} ({digits} digits)
+Using B1=10000000000-10000000000, B2=13412040301838880, polynomial x^1, x0=12
+Step 1 took 0ms
+Step 2 took 123456ms
+********** Factor found in step 2: {f}
+Found prime factor of {f_digits} digits: {f}
+Composite cofactor {n} has {digits} digits
+"""
+
+
+def write_synthetic_log(fn, size_mb, factor_rate=1e-4):
+    random.seed(1)
+    target = size_mb * 1024 ** 2
+    written = 0
+    with open(fn, "w") as f:
+        while written < target:
+            n = random.getrandbits(random.randint(400, 2040)) | 1
+            if random.random() < factor_rate:
+                factor = random.getrandbits(150) | 1
+                run = FACTOR.format(n=n, digits=len(str(n)), f=factor, f_digits=len(str(factor)))
+            else:
+                run = RUN.format(n=n, digits=len(str(n)))
+            f.write(run)
+            written += len(run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streaming ECM log parsing')
+    parser.add_argument('--size', type=int, default=1024, help='size of synthetic log in MB')
+    parser.add_argument('--log', default='bench_synthetic.log', help='synthetic log filename')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.log):
+        print(f"Writing {args.size} MB synthetic log to {args.log!r}")
+        write_synthetic_log(args.log, args.size)
+
+    size = os.path.getsize(args.log)
+    stats = Counter()
+    found = 0
+    start = time.time()
+    for f, run in process_ecm_logs.iter_log_factors(args.log, stats):
+        found += 1
+    elapsed = time.time() - start
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Parsed {size / 1024 ** 2:.0f} MB, {stats['runs']} runs, {stats['lines']} lines, {found} factors")
+    print(f"\t{elapsed:.1f} seconds, {stats['lines'] / elapsed:,.0f} lines/sec, {size / 1024 ** 2 / elapsed:.1f} MB/sec")
+    print(f"\tPeak RSS {peak_rss:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,15 @@
 # to test 10 numbers
 #  $ python check_resume.py --samples 10
 #
+# to spot check 20 lines spread over kernel sizes, stops on the first wrong line
+#  $ python check_resume.py --stratify -n 20 batch.resume.txt
+#
+# to check 200 P-1 lines in python (no ecm binary needed)
+#  $ python check_resume.py --verify -n 200 batch.resume.txt
+#
+# to only validate the CHECKSUM of every line (also done before spot checking)
+#  $ python check_resume.py --checksum *.resume.txt
+#
 # to see all options
 #  $ python check_resume.py -h
 #
@@ -15,14 +24,23 @@
 #    'Wrong result for <fn>:<line>: LINE'
 
 import argparse
+import hashlib
+import heapq
+import itertools
 import multiprocessing
 import os
 import random
 import re
+import signal
 import subprocess
 import sys
+import tempfile
 import time
 
+import ecm_resume
+import gpu_cost
+import pm1_stage1
+
 
 parser = argparse.ArgumentParser(description='ecm resume files testing and spot verification')
 
@@ -40,6 +58,16 @@ parser.add_argument('--seed', type=int, default=1,
 parser.add_argument('-t', '--threads', type=int, default=4,
     help="Number of simultanious process to run for spot checking")
 
+parser.add_argument('--verify', action='store_true',
+    help='Recompute P-1 stage 1 in python (gmpy2) instead of running ecm')
+parser.add_argument('--no-n-squared', action='store_false', dest='n_squared',
+    help='With --verify, stage 1 was run without the initial N^2-1 exponent (ecm -go)')
+
+parser.add_argument('--stratify', action='store_true',
+    help='Spot check lines from every kernel size, stop on the first mismatch')
+parser.add_argument('--checksum', action='store_true',
+    help='Only validate the CHECKSUM of every line of every file')
+
 parser.add_argument('--verbose', '-v', action='count', default=1,
     help='Print more output (pass -v -v for even more)')
 parser.add_argument('--quiet', '-q',
@@ -48,32 +76,6 @@ parser.add_argument('--quiet', '-q',
 
 
 
-def parse_resume(line):
-    """Parse an ECM resume line."""
-    IGNORE = ["PROGRAM", "WHO", "TIME"]
-    INT = ["N", "B1", "X", "Y", "X0", "Y0", "CHECKSUM"]
-
-    parsed = {}
-    for part in line.split(";"):
-        part = part.strip()
-        if not part:
-            continue
-
-        key, value = part.split("=", 1)
-        if key in IGNORE:
-            continue
-
-        if key in INT:
-            if value.startswith("0x"):
-                value = int(value, 16)
-            else:
-                value = int(value)
-
-        assert key not in parsed, f"Duplicate key: {key}"
-        parsed[key] = value
-
-    return parsed
-
 def entries_match(e_a, e_b):
     """Check if two entries (parsed_resume lines) match."""
     # Use dict so order is preserved
@@ -88,6 +90,10 @@ def entries_match(e_a, e_b):
         if k in ("COMMENT", ):
             continue
 
+        # Rebatched lines have no CHECKSUM (see update_resume)
+        if k == "CHECKSUM" and None in (v_a, v_b):
+            continue
+
         # missing zeros is probably fine for these fields
         if k in ("X", "Y", "X0", "Y0") and v_a in (0, None) and v_b in (0, None):
             continue
@@ -104,8 +110,8 @@ def read_and_parse_resume_file(fn):
             if not line:
                 continue
 
-            p = parse_resume(line)
-            keys = ("METHOD", "N", "B1", "CHECKSUM")
+            p = ecm_resume.ResumeLine(line)
+            keys = ("METHOD", "N", "B1")
             if any(key not in p for key in keys):
                 print("BAD Resume line {i} in {fn}: {abbr(line)}")
                 continue
@@ -113,58 +119,176 @@ def read_and_parse_resume_file(fn):
             yield p, line
 
 
-def diff_resume_files(args, fn_a, fn_b):
-    """Compare the results in two files."""
+def check_checksums(args, fn):
+    """
+    Validate CHECKSUM of every line in fn, returns number of bad lines.
 
-    def abbr(line, n=30):
-        return line if len(line) <= n + 3 else (line[:n] + "...")
+    Lines without CHECKSUM (update_resume strips it when rebatching) are
+    counted as unchecked, not bad.
+    """
+    bad = 0
+    count = 0
+    unchecked = 0
+    with open(fn) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
 
-    def read_and_parse(fn):
-        lines = {}
-        for p, line in read_and_parse_resume_file(fn):
-            key = p["METHOD"] + "_" + str(p["N"])
-            if key in lines:
-                print("Ignoring duplicate entry for", key)
+            count += 1
+            p = ecm_resume.ResumeLine(line)
+            if "CHECKSUM" not in p:
+                unchecked += 1
                 continue
 
-            lines[key] = (p, line)
-        return lines
+            try:
+                ok = int(p.raw("CHECKSUM")) == ecm_resume.checksum(p)
+            except (KeyError, ValueError):
+                ok = False
+
+            if not ok:
+                bad += 1
+                print(f"Bad checksum for {fn}:{i}: {line[:80]}...")
 
+    if unchecked:
+        print(f"{unchecked} of {count} lines in {fn!r} have no CHECKSUM (unchecked)")
     if args.verbose:
-        print(f"Comparing resume files: {fn_a!r} and {fn_b!r}")
+        print(f"Checked {count - unchecked} lines in {fn!r}, {bad} bad checksums")
+    return bad
+
+
+# Lines per sorted run (temporary file) for diff_resume_files
+SORT_RUN_LINES = 100000
+
+
+def _write_sorted_runs(fn, tmpdir):
+    """Split fn into temporary files each sorted by METHOD + hash(N)."""
+    runs = []
+
+    def flush(entries):
+        # sort is stable so the first of duplicate lines stays first.
+        entries.sort(key=lambda e: e[0])
+        path = os.path.join(tmpdir, f"run_{len(runs)}_{os.path.basename(fn)}")
+        with open(path, "w") as f:
+            for key, line in entries:
+                f.write(f"{key}\t{line}\n")
+        runs.append(path)
+
+    entries = []
+    for p, line in read_and_parse_resume_file(fn):
+        n_hash = hashlib.sha1(str(p["N"]).encode()).hexdigest()
+        entries.append((p["METHOD"] + "_" + n_hash, line))
+        if len(entries) == SORT_RUN_LINES:
+            flush(entries)
+            entries = []
+    if entries or not runs:
+        flush(entries)
+    return runs
+
+
+def _iter_run(path):
+    with open(path) as f:
+        for row in f:
+            key, line = row.rstrip("\n").split("\t", 1)
+            yield key, line
+
+
+def _line_key(line):
+    p = ecm_resume.ResumeLine(line)
+    return p["METHOD"] + "_" + str(p["N"])
+
+
+def _iter_sorted(runs, print_duplicates):
+    """Merge sorted runs, yields (key, line) skipping all but the first line of each key."""
+    last = None
+    for key, line in heapq.merge(*map(_iter_run, runs), key=lambda e: e[0]):
+        if key == last:
+            if print_duplicates:
+                print("Ignoring duplicate entry for", _line_key(line))
+            continue
+        last = key
+        yield key, line
+
+
+def _merge_join(runs_a, runs_b, print_duplicates=False):
+    """Yields (line_a or None, line_b or None) for every key in either file."""
+    a = _iter_sorted(runs_a, print_duplicates)
+    b = _iter_sorted(runs_b, print_duplicates)
+    entry_a = next(a, None)
+    entry_b = next(b, None)
+    while entry_a or entry_b:
+        if entry_b is None or (entry_a and entry_a[0] < entry_b[0]):
+            yield entry_a[1], None
+            entry_a = next(a, None)
+        elif entry_a is None or entry_b[0] < entry_a[0]:
+            yield None, entry_b[1]
+            entry_b = next(b, None)
+        else:
+            yield entry_a[1], entry_b[1]
+            entry_a = next(a, None)
+            entry_b = next(b, None)
 
-    a = read_and_parse(fn_a)
-    b = read_and_parse(fn_b)
 
-    if len(b) > len(a):
-        a, b = b, a
-        fn_a, fn_b = fn_b, fn_a
+def diff_resume_files(args, fn_a, fn_b):
+    """
+    Compare the results in two files.
 
-    is_superset = a.keys() >= b.keys()
+    Both files are externally sorted by METHOD + hash(N) then merged so
+    memory use doesn't depend on file size. Lines are printed in that order.
+    """
 
-    matching = 0
-    mismatches = 0
-    for k, (p_a, a_line) in a.items():
-        if k in b:
-            match, diff = entries_match(p_a, b[k][0])
-            if match:
-                matching += 1
-            else:
-                mismatches += 1
-                print(f"\tMISMATCH {mismatches}: {diff} | {k}")
+    def abbr(line, n=30):
+        return line if len(line) <= n + 3 else (line[:n] + "...")
 
-        if not is_superset:
-            print("\tPresent only in {fn_a}: {abbr(a_line, 50)}")
-            continue
+    if args.verbose:
+        print(f"Comparing resume files: {fn_a!r} and {fn_b!r}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        runs_a = _write_sorted_runs(fn_a, tmpdir)
+        runs_b = _write_sorted_runs(fn_b, tmpdir)
+
+        # First pass only counts keys
+        len_a = len_b = only_a = only_b = 0
+        for line_a, line_b in _merge_join(runs_a, runs_b, print_duplicates=True):
+            len_a += line_a is not None
+            len_b += line_b is not None
+            only_a += line_b is None
+            only_b += line_a is None
+
+        if len_b > len_a:
+            runs_a, runs_b = runs_b, runs_a
+            fn_a, fn_b = fn_b, fn_a
+            len_a, len_b = len_b, len_a
+            only_a, only_b = only_b, only_a
+
+        is_superset = only_b == 0
+
+        matching = 0
+        mismatches = 0
+        for a_line, b_line in _merge_join(runs_a, runs_b):
+            if a_line is None:
+                continue
 
-    if not is_superset:
-        for k, e in b.items():
-            if k not in a:
+            if b_line is not None:
+                p_a = ecm_resume.ResumeLine(a_line)
+                match, diff = entries_match(p_a, ecm_resume.ResumeLine(b_line))
+                if match:
+                    matching += 1
+                else:
+                    mismatches += 1
+                    print(f"\tMISMATCH {mismatches}: {diff} | {_line_key(a_line)}")
+
+            if not is_superset:
+                print("\tPresent only in {fn_a}: {abbr(a_line, 50)}")
+                continue
+
+        if not is_superset:
+            for _ in range(only_b):
                 print("\tPresent only in {fn_b}: {abbr(a_line, 50)}")
                 continue
 
     if args.verbose:
-        print(f"{matching} lines matched. Files had {len(a)} and {len(b)} lines")
+        print(f"{matching} lines matched. Files had {len_a} and {len_b} lines")
 
     if mismatches:
         print(f"ERROR: files had {mismatches} mismatches")
@@ -179,28 +303,81 @@ def _run_cmd(command):
             stderr=subprocess.STDOUT,
             shell=True)
 
-def spot_check(args):
-    """Read a resume file, select a set of lines to try and verify, run ecm, verify."""
+def _ecm_command(ecm, parsed, save_fn):
+    method = {"P-1": "-pm1", "P+1": "pp1", "ECM": ""}[parsed['METHOD']]
+    B1 = parsed["B1"]
+    X0 = parsed["X0"]
+    N = parsed["N"]
+    return f'echo "{N}" | {ecm} {method} -savea "{save_fn}" -x0 {X0} {B1} 0'
+
+
+def _sample_lines(lines, count):
+    """Returns indexes of the first, (count-2) random and last lines."""
+    N = min(count, len(lines))
+    assert N > 0
 
+    indexes = [0]
+    if N > 2:
+        indexes.extend(sorted(random.sample(range(1, len(lines)-1), N-2)))
+    if N > 1:
+        indexes.append(len(lines) - 1)
+
+    assert len(indexes) == N, (len(indexes), N)
+    return indexes
+
+
+def _sample_lines_stratified(lines, count):
+    """
+    Returns indexes of count lines spread over the CGBN kernel sizes in lines.
+
+    Every kernel gets at least one sample (if count allows) the rest are split
+    proportional to the number of lines of each kernel.
+    """
+    buckets = {}
+    for i, (parsed, line) in enumerate(lines):
+        # Numbers too large for any kernel share one bucket
+        kernel = gpu_cost.kernel_bits(parsed["N"].bit_length(), gpu_cost.KERNEL_BITS + [2 ** 16])
+        buckets.setdefault(kernel, []).append(i)
+
+    count = min(count, len(lines))
+    assert count > 0
+
+    kernels = sorted(buckets, key=lambda k: -len(buckets[k]))
+    wanted = {k: 0 for k in kernels}
+    for k in kernels[:count]:
+        wanted[k] = 1
+    for k in kernels:
+        extra = (count - len(kernels)) * len(buckets[k]) // len(lines)
+        wanted[k] = min(len(buckets[k]), wanted[k] + max(0, extra))
+
+    # Rounding leftovers go to the largest buckets
+    for k in itertools.cycle(kernels):
+        if sum(wanted.values()) >= count:
+            break
+        if wanted[k] < len(buckets[k]):
+            wanted[k] += 1
+
+    indexes = []
+    for k in sorted(buckets):
+        indexes.extend(random.sample(buckets[k], wanted[k]))
+        print(f"\t{k} bit kernel: {wanted[k]} of {len(buckets[k])} lines")
+    return sorted(indexes)
+
+
+def _read_lines(args):
     fn = args.resume_files[0]
     assert os.path.isfile(fn), fn
     lines = list(read_and_parse_resume_file(fn))
     if args.verbose:
         print(f"Found {len(lines)} lines in {fn!r}")
+    return fn, lines
 
-    N = min(args.count, len(lines))
-    assert N > 0
 
-    # First, (N-2) random, Last
-    samples = [lines[0]]
-    if N > 2:
-        indexes = sorted(random.sample(range(1, len(lines)-1), N-2))
-        for line_i in indexes:
-            samples.append(lines[line_i])
-    if N > 1:
-        samples.append(lines[-1])
+def spot_check(args):
+    """Read a resume file, select a set of lines to try and verify, run ecm, verify."""
 
-    assert len(samples) == N, (len(samples), N)
+    fn, lines = _read_lines(args)
+    samples = [lines[i] for i in _sample_lines(lines, args.count)]
 
     ecm = args.ecm_cmd
     ts = int(time.time())
@@ -209,14 +386,7 @@ def spot_check(args):
     filename = filename.removesuffix(".txt")
     save_fn = os.path.join(folder, f"verify_{ts}_{filename}.txt")
 
-    commands = []
-    for parsed, line in samples:
-        method = {"P-1": "-pm1", "P+1": "pp1", "ECM": ""}[parsed['METHOD']]
-        B1 = parsed["B1"]
-        X0 = parsed["X0"]
-        N = parsed["N"]
-        cmd = f'echo "{N}" | {ecm} {method} -savea "{save_fn}" -x0 {X0} {B1} 0'
-        commands.append(cmd)
+    commands = [_ecm_command(ecm, parsed, save_fn) for parsed, line in samples]
 
     with multiprocessing.Pool(processes=args.threads) as pool:
             results = pool.map(_run_cmd, commands)
@@ -230,6 +400,131 @@ def spot_check(args):
     diff_resume_files(args, fn, save_fn)
 
 
+# Subprocess of the current spot check in each stratified spot check worker
+_current_proc = None
+
+
+def _kill_current_proc(signum, frame):
+    if _current_proc is not None and _current_proc.poll() is None:
+        os.killpg(_current_proc.pid, signal.SIGKILL)
+    os._exit(1)
+
+
+def _init_spot_worker():
+    # Pool.terminate() sends SIGTERM, also kill the running ecm.
+    signal.signal(signal.SIGTERM, _kill_current_proc)
+
+
+def _run_and_compare(sample):
+    """Worker for stratified_spot_check, returns (index, match, diff)."""
+    global _current_proc
+    i, line, command, save_fn, verbose = sample
+    output = None if verbose > 1 else subprocess.DEVNULL
+    _current_proc = subprocess.Popen(
+            command, shell=True, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+    returncode = _current_proc.wait()
+    _current_proc = None
+
+    saved = list(read_and_parse_resume_file(save_fn)) if os.path.exists(save_fn) else []
+    if len(saved) != 1:
+        return i, False, ("ecm", returncode, len(saved))
+
+    match, diff = entries_match(ecm_resume.ResumeLine(line), saved[0][0])
+    return i, match, diff
+
+
+def stratified_spot_check(args):
+    """
+    Spot check lines from every kernel size, stops at the first mismatch.
+
+    Every sample has its own save file and is compared as soon as its ecm
+    finishes, progress is printed as results come in.
+    """
+    fn, lines = _read_lines(args)
+    indexes = _sample_lines_stratified(lines, args.count)
+
+    ts = int(time.time())
+    folder, filename = os.path.split(fn)
+    filename = filename.removesuffix(".txt")
+
+    samples = []
+    for i in indexes:
+        parsed, line = lines[i]
+        save_fn = os.path.join(folder, f"verify_{ts}_{filename}_{i}.txt")
+        samples.append((i, line, _ecm_command(args.ecm_cmd, parsed, save_fn), save_fn, args.verbose))
+
+    start = time.time()
+    verified = 0
+    pool = multiprocessing.Pool(processes=args.threads, initializer=_init_spot_worker)
+    try:
+        for i, match, diff in pool.imap_unordered(_run_and_compare, samples):
+            if not match:
+                print()
+                print(f"MISMATCH: {diff}")
+                print(f"Wrong result for {fn}:{i}: {lines[i][1]}")
+                pool.terminate()
+                return 1
+
+            verified += 1
+            if args.verbose:
+                print(f"\rVerified {verified}/{len(samples)} ({time.time() - start:.0f}s)",
+                      end="", flush=True)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if args.verbose:
+        print()
+        print(f"All {verified} samples matched")
+    return 0
+
+
+def _verify_chunk(chunk):
+    """Worker for verify, returns [(index, matches)] for lines with the same B1."""
+    B1, n_squared, entries = chunk
+    xs = pm1_stage1.stage1(
+        [N for _, N, _, _ in entries], [X0 for _, _, X0, _ in entries], B1, n_squared)
+    return [(i, x == X) for (i, _, _, X), x in zip(entries, xs)]
+
+
+def verify(args):
+    """Read a resume file, select lines and recompute P-1 stage 1 in process."""
+
+    fn, lines = _read_lines(args)
+    indexes = _sample_lines(lines, args.count)
+
+    by_B1 = {}
+    for i in indexes:
+        parsed, line = lines[i]
+        if parsed["METHOD"] != "P-1":
+            print(f"Skipping {parsed['METHOD']} line {i}, only P-1 can be verified")
+            continue
+        by_B1.setdefault(parsed["B1"], []).append((i, parsed["N"], parsed["X0"], parsed["X"]))
+
+    # Every worker computes the stage 1 exponent once for a chunk of lines.
+    chunks = []
+    for B1, entries in sorted(by_B1.items()):
+        size = -(-len(entries) // args.threads)
+        for start in range(0, len(entries), size):
+            chunks.append((B1, args.n_squared, entries[start:start+size]))
+
+    if args.verbose:
+        print(f"Verifying {sum(len(c[2]) for c in chunks)} lines in {len(chunks)} chunks")
+
+    wrong = 0
+    with multiprocessing.Pool(processes=args.threads) as pool:
+        for results in pool.imap_unordered(_verify_chunk, chunks):
+            for i, matches in results:
+                if not matches:
+                    wrong += 1
+                    print(f"Wrong result for {fn}:{i}: {lines[i][1]}")
+
+    if args.verbose:
+        print(f"{sum(len(c[2]) for c in chunks) - wrong} lines verified, {wrong} wrong")
+
+    return wrong
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -238,7 +533,18 @@ if __name__ == '__main__':
     if seed is None:
         args.seed = random.randrange(2 ^ 32)
 
-    if len(args.resume_files) == 1:
+    if args.checksum:
+        bad = sum(check_checksums(args, fn) for fn in args.resume_files)
+        exit(0 if bad == 0 else 1)
+    elif len(args.resume_files) == 1 and check_checksums(args, args.resume_files[0]):
+        # Don't spend time spot checking a file with corrupted lines.
+        exit(1)
+    elif len(args.resume_files) == 1 and args.verify:
+        wrong = verify(args)
+        exit(0 if wrong == 0 else 1)
+    elif len(args.resume_files) == 1 and args.stratify:
+        exit(stratified_spot_check(args))
+    elif len(args.resume_files) == 1:
         spot_check(args)
     elif len(args.resume_files) == 2:
         mismatches = diff_resume_files(args, *args.resume_files)
@@ -1,8 +1,22 @@
+import ast
+import operator
+
+
+IGNORE = ("PROGRAM", "WHO", "TIME")
+INT = ("N", "B1", "X", "Y", "X0", "Y0", "CHECKSUM")
+
+# CHECKSUM is a product of fields mod this prime, see write_resumefile() in GMP-ECM's resume.c
+CHKSUMMOD = 4294967291
+
+
+def _to_int(value):
+    if value.startswith("0x"):
+        return int(value, 16)
+    return int(value)
+
+
 def parse_resume(line):
     """Parse an ECM resume line."""
-    IGNORE = ["PROGRAM", "WHO", "TIME"]
-    INT = ["N", "B1", "X", "Y", "X0", "Y0", "CHECKSUM"]
-
     parsed = {}
     for part in line.split(";"):
         part = part.strip()
@@ -14,12 +28,166 @@ def parse_resume(line):
             continue
 
         if key in INT:
-            if value.startswith("0x"):
-                value = int(value, 16)
-            else:
-                value = int(value)
+            value = _to_int(value)
 
         assert key not in parsed, f"Duplicate key: {key}"
         parsed[key] = value
 
     return parsed
+
+
+class ResumeLine:
+    """
+    Lazily parsed ECM resume line.
+
+    Acts like the dict from parse_resume() but each field is located (with
+    str.find) and decoded the first time it is accessed. Useful when only N
+    and B1 are needed and X is hundreds of hex digits.
+    """
+
+    __slots__ = ("line", "_keys", "_spans", "_values")
+
+    def __init__(self, line):
+        self.line = line
+        self._keys = None
+        self._spans = {}
+        self._values = {}
+
+    def _span(self, key):
+        """(start, end) of the value of key in line or None."""
+        spans = self._spans
+        if key in spans or self._keys is not None:
+            return spans.get(key)
+
+        span = None
+        if key not in IGNORE:
+            line = self.line
+            needle = key + "="
+            i = line.find(needle)
+            # Skip matches that are the end of a longer key.
+            while i > 0 and line[i - 1] not in "; ":
+                i = line.find(needle, i + 1)
+
+            if i != -1:
+                start = i + len(needle)
+                end = line.find(";", start)
+                span = (start, end if end != -1 else len(line))
+
+        spans[key] = span
+        return span
+
+    def keys(self):
+        """All keys in order (this checks every part of the line)."""
+        if self._keys is None:
+            line = self.line
+            keys = []
+            spans = {}
+            start = 0
+            while start < len(line):
+                end = line.find(";", start)
+                if end == -1:
+                    end = len(line)
+
+                equals = line.find("=", start, end)
+                if equals == -1:
+                    assert not line[start:end].strip(), f"Bad part: {line[start:end]}"
+                else:
+                    key = line[start:equals].strip()
+                    if key not in IGNORE:
+                        assert key not in spans, f"Duplicate key: {key}"
+                        keys.append(key)
+                        spans[key] = (equals + 1, end)
+
+                start = end + 1
+
+            self._keys = keys
+            self._spans = spans
+        return self._keys
+
+    def raw(self, key):
+        """Undecoded string value of key."""
+        span = self._span(key)
+        if span is None:
+            raise KeyError(key)
+        return self.line[span[0]:span[1]].strip()
+
+    def is_zero(self, key):
+        """Check if an INT field is zero without decoding it."""
+        return not self.raw(key).removeprefix("0x").strip("0")
+
+    def __getitem__(self, key):
+        value = self._values.get(key)
+        if value is None:
+            value = self.raw(key)
+            if key in INT:
+                value = _to_int(value)
+            self._values[key] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        return self._span(key) is not None
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+
+def parse_many(lines):
+    """
+    Lazily parse many resume lines, skipping blank lines.
+
+    Nothing is decoded until accessed so callers that only look at N and B1
+    never pay for converting X.
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield ResumeLine(line)
+
+
+_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.floordiv,
+    ast.Pow: operator.pow,
+}
+
+
+def expression_to_int(expression):
+    """Value of N which GMP-ECM writes as given e.g. "(2^499-1)/20959"."""
+    if expression.isdigit():
+        return int(expression)
+
+    def evaluate(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, int):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+            return _OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        raise ValueError(f"Unsupported expression: {expression}")
+
+    return evaluate(ast.parse(expression.replace("^", "**"), mode="eval").body)
+
+
+def checksum(parsed):
+    """
+    Compute CHECKSUM of a resume line (ResumeLine or dict with N as a string).
+
+    B1 * SIGMA * N * X [* Y] * (PARAM + 1) mod CHKSUMMOD, SIGMA and PARAM
+    are only present for ECM.
+    """
+    M = CHKSUMMOD
+    check = int(parsed["B1"]) % M
+    if "SIGMA" in parsed:
+        check = check * (int(parsed["SIGMA"]) % M) % M
+
+    N = parsed.raw("N") if isinstance(parsed, ResumeLine) else str(parsed["N"])
+    check = check * (expression_to_int(N) % M) % M
+    check = check * (parsed["X"] % M) % M
+    if "Y" in parsed:
+        check = check * (parsed["Y"] % M) % M
+    if "PARAM" in parsed:
+        check = check * (int(parsed["PARAM"]) + 1) % M
+    return check
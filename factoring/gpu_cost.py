@@ -0,0 +1,85 @@
+"""
+Measured GPU (CGBN) P-1 stage 1 throughput for one GPU.
+
+Cost files have one kernel per line ('#' starts a comment)
+
+    # kernel_bits  curves_per_launch  seconds_per_curve (B1=1e9, full launch)
+    1280           2048               0.95
+    1536           2048               1.31
+    overhead       60
+    stage2         30
+
+A launch always runs curves_per_launch curves so a partial launch costs the
+same as a full one. overhead is a fixed cost (in seconds) for every batch.
+stage2 (optional) is the CPU stage 2 wall time per number (in seconds) on
+the same machine.
+"""
+
+import math
+
+
+# A number fits in a kernel if bits < kernel - 8
+KERNEL_BITS = [128 * k for k in (10, 12, 14, 16, 20)]
+KERNEL_MARGIN = 8
+
+
+def kernel_bits(bits, kernels=KERNEL_BITS):
+    """Smallest kernel that fits a number of bits."""
+    for kernel in sorted(kernels):
+        if bits < kernel - KERNEL_MARGIN:
+            return kernel
+    raise ValueError(f"No kernel for {bits} bits")
+
+
+class GpuCostModel:
+    def __init__(self, kernels, overhead=0, stage2=0):
+        """kernels is {kernel_bits: (curves_per_launch, seconds_per_curve at B1=1e9)}"""
+        assert kernels
+        self.kernels = dict(sorted(kernels.items()))
+        self.overhead = overhead
+        self.stage2 = stage2
+
+    @classmethod
+    def from_file(cls, fn):
+        kernels = {}
+        overhead = 0
+        stage2 = 0
+        with open(fn) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+
+                parts = line.split()
+                if parts[0] == "overhead":
+                    overhead = float(parts[1])
+                    continue
+                if parts[0] == "stage2":
+                    stage2 = float(parts[1])
+                    continue
+
+                kernel, width, seconds = parts
+                kernels[int(kernel)] = (int(width), float(seconds))
+        return cls(kernels, overhead, stage2)
+
+    def kernel(self, bits):
+        return kernel_bits(bits, self.kernels)
+
+    def curve_seconds(self, kernel, B1):
+        """Seconds per curve (in a full launch) for stage 1 to B1."""
+        return self.kernels[kernel][1] * B1 / 1e9
+
+    def batch_size(self, kernel, B1, batch_seconds):
+        """Largest batch (multiple of launch width) that finishes in batch_seconds."""
+        width = self.kernels[kernel][0]
+        launches = int((batch_seconds - self.overhead) / (width * self.curve_seconds(kernel, B1)))
+        return max(1, launches) * width
+
+    def seconds(self, count, kernel, B1, batch_seconds=None):
+        """Predicted seconds for count curves on kernel split into batches of at most batch_seconds."""
+        width = self.kernels[kernel][0]
+        batches = 1
+        if batch_seconds:
+            batches = math.ceil(count / self.batch_size(kernel, B1, batch_seconds))
+        launches = math.ceil(count / width)
+        return launches * width * self.curve_seconds(kernel, B1) + batches * self.overhead
@@ -20,5 +20,6 @@ make -j
 
 # scp files
 #scp -P<P> resumes_20260130/* "root@<MACHINE>:~/resumes_20260130/"
+#scp -P<P> run_batches.py ecm_resume.py "root@<MACHINE>:/workspace/gmp-ecm/"
 
-./run_batches.sh resumes_20260130/ pm1_stdkmd_batch_01_799.resume.txt 4
+python run_batches.py batches.json --add resumes_20260130/pm1_stdkmd_batch_01_799.resume.txt --limit 4e8
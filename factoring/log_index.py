@@ -0,0 +1,117 @@
+"""
+SQLite index of found factors in ECM / P-1 log files.
+
+For every factor the file, byte offset and length of the run that found it
+are stored (plus METHOD, B1 and B2 from the run's "Using" line) so the log for
+a factor can be read back with a single seek. Like residual_store.py files are
+indexed incrementally, only bytes appended since the last update are parsed.
+"""
+
+import json
+import os
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS factors (
+    factor TEXT NOT NULL,
+    file TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    method TEXT,
+    b1 INTEGER,
+    b2 INTEGER,
+    PRIMARY KEY (factor, file, offset)
+);
+CREATE INDEX IF NOT EXISTS factors_file ON factors (file, offset);
+"""
+
+
+def read_run(path, offset, length):
+    """Read back one run, a list of lines (or [wu, result] for ecm-db json logs)."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length).decode()
+
+    if path.endswith("json.log"):
+        return json.loads(data)
+    return [line.strip() for line in data.splitlines()]
+
+
+class LogIndex:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def pending(self, fn):
+        """
+        (start, end) byte range of fn that hasn't been indexed.
+
+        end is the end of the last complete line. If fn was replaced or
+        truncated its old entries are dropped and start is 0.
+        """
+        path = os.path.abspath(fn)
+        st = os.stat(path)
+
+        end = st.st_size
+        with open(path, "rb") as f:
+            # Don't index a partial line that is still being written
+            while end > 0:
+                f.seek(max(0, end - 4096))
+                block = f.read(end - f.tell())
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    end -= len(block) - newline - 1
+                    break
+                end -= len(block)
+
+        row = self.db.execute("SELECT inode, offset FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return 0, end
+        if row[0] != st.st_ino or row[1] > end:
+            # File was replaced or truncated, start over.
+            with self.db:
+                self.db.execute("DELETE FROM factors WHERE file = ?", (path,))
+                self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            return 0, end
+        return row[1], end
+
+    def add(self, fn, entries, offset):
+        """
+        Record entries [(factor, offset, length, method, B1, B2)] from fn and
+        that fn has been indexed up to offset.
+        """
+        path = os.path.abspath(fn)
+        inode = os.stat(path).st_ino
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO factors VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(str(f), path, *rest) for f, *rest in entries])
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, inode, offset))
+
+    def lookup(self, factor):
+        """[(file, offset, length, method, B1, B2)] of runs that found factor."""
+        return self.db.execute(
+            "SELECT file, offset, length, method, b1, b2 FROM factors WHERE factor = ?"
+            " ORDER BY file, offset", (str(factor),)).fetchall()
+
+    def factors(self, fns):
+        """Yield (factor, file, offset, length) for all factors found in fns."""
+        for fn in fns:
+            path = os.path.abspath(fn)
+            for f, offset, length in self.db.execute(
+                    "SELECT factor, offset, length FROM factors WHERE file = ? ORDER BY offset",
+                    (path,)):
+                yield int(f), path, offset, length
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM factors").fetchone()[0]
@@ -0,0 +1,71 @@
+"""
+P-1 stage 1 in python with gmpy2, used by check_resume.py --verify.
+
+Stage 1 computes X = X0^E mod N with E the product of all prime powers
+p^k <= B1, like GMP-ECM (without -go) X0 is first raised to N^2 - 1.
+
+E has ~1.44 * B1 bits so it's never built in full. Primes come from a
+segmented sieve and E is applied one segment (product tree of that segment's
+prime powers) at a time to every line sharing the same B1.
+"""
+
+import itertools
+import math
+
+import gmpy2
+
+import product_tree
+
+
+SEGMENT_SIZE = 2 ** 22
+
+
+def _small_primes(limit):
+    """Primes <= limit."""
+    sieve = bytearray([1]) * (limit + 1)
+    sieve[:2] = b"\x00\x00"
+    for p in range(2, math.isqrt(limit) + 1):
+        if sieve[p]:
+            sieve[p*p::p] = bytes(len(range(p*p, limit + 1, p)))
+    return [p for p in range(limit + 1) if sieve[p]]
+
+
+def iter_prime_segments(limit, segment_size=SEGMENT_SIZE):
+    """Yield lists of primes <= limit, one segment of segment_size numbers at a time."""
+    base = _small_primes(math.isqrt(limit))
+    for start in range(0, limit + 1, segment_size):
+        stop = min(start + segment_size, limit + 1)
+        sieve = bytearray([1]) * (stop - start)
+        for p in base:
+            if p * p >= stop:
+                break
+            first = max(p * p, (start + p - 1) // p * p)
+            sieve[first - start::p] = bytes(len(range(first, stop, p)))
+
+        if start == 0:
+            sieve[:2] = b"\x00\x00"
+        yield list(itertools.compress(range(start, stop), sieve))
+
+
+def iter_exponent_segments(B1, segment_size=SEGMENT_SIZE):
+    """Yield pieces of E, their product is prod(p^k <= B1)."""
+    for primes in iter_prime_segments(B1, segment_size):
+        powers = []
+        for p in primes:
+            q = p
+            while q * p <= B1:
+                q *= p
+            powers.append(q)
+        if powers:
+            yield product_tree.product_tree(powers)[-1][0]
+
+
+def stage1(numbers, x0s, B1, n_squared=True):
+    """X0^E mod N for lists of N and X0 sharing the same B1."""
+    ns = [gmpy2.mpz(n) for n in numbers]
+    xs = [gmpy2.mpz(x0) for x0 in x0s]
+    if n_squared:
+        xs = [gmpy2.powmod(x, n * n - 1, n) for x, n in zip(xs, ns)]
+    for e in iter_exponent_segments(B1):
+        xs = [gmpy2.powmod(x, e, n) for x, n in zip(xs, ns)]
+    return [int(x) for x in xs]
@@ -0,0 +1,123 @@
+"""
+Probability of P-1 finding a new factor of a composite, pure python.
+
+Same model as mersenne/pm1_prob/pm1.sage (adapted from GpuOwl's pm1.cpp) but
+for general composites. Dickman's rho is tabulated by integrating
+rho'(u) = -rho(u-1) / u instead of calling sage's dickman_rho().
+
+Factor sizes are integrated in slices from `cleared` (e.g. 10^30 after ECM)
+up to sqrt(N), the chance of a prime factor in [a, b] is log(log(b)) - log(log(a)).
+"""
+
+import functools
+import math
+
+
+# Table of rho(u) for u in [0, RHO_MAX] with RHO_STEPS points per unit
+RHO_MAX = 64
+RHO_STEPS = 256
+
+# Largest factor considered, sqrt of the largest (2048 bit) composite.
+MAX_FACTOR_LOG = 1024 * math.log(2)
+SLICES = 200
+
+
+@functools.cache
+def _rho_table():
+    # u * rho(u) = integral of rho(t) from u-1 to u (trapezoid rule), all terms
+    # are positive so this is stable where rho(u) is tiny.
+    h = 1 / RHO_STEPS
+    table = [1.0] * (RHO_STEPS + 1)
+    for i in range(RHO_STEPS + 1, RHO_MAX * RHO_STEPS + 1):
+        u = i * h
+        # Not a running sum, that loses all precision once rho is small.
+        inner = sum(table[i - RHO_STEPS + 1:i])
+        rho = h * (table[i - RHO_STEPS] / 2 + inner) / (u - h / 2)
+        table.append(rho)
+    return table
+
+
+def dickman_rho(u):
+    """Probability that a random number n is n^(1/u)-smooth."""
+    if u <= 1:
+        return 1.0
+    if u >= RHO_MAX:
+        return 0.0
+
+    table = _rho_table()
+    x = u * RHO_STEPS
+    i = int(x)
+    a, b = table[i], table[i + 1]
+    if a <= 0 or b <= 0:
+        return 0.0
+    # Interpolate in log space, rho falls off quickly.
+    return math.exp(math.log(a) + (x - i) * (math.log(b) - math.log(a)))
+
+
+def prob_stage1(alpha):
+    """Probability that the largest factor is < B1 (alpha = log(p) / log(B1))."""
+    return dickman_rho(alpha)
+
+
+def prob_stage2(alpha, beta, steps=32):
+    """
+    Probability of finding factor in 2nd stage (beta = log(p) / log(B2)).
+
+    Integral of rho(alpha - x) / x from 1 to alpha / beta, see pm1.sage
+    """
+    assert alpha >= beta
+    lo, hi = 1, alpha / beta
+    if hi <= lo:
+        return 0.0
+
+    # Simpson's rule
+    h = (hi - lo) / steps
+    total = 0
+    for i in range(steps + 1):
+        x = lo + i * h
+        weight = 1 if i in (0, steps) else (4 if i % 2 else 2)
+        total += weight * dickman_rho(alpha - x) / x
+    return total * h / 3
+
+
+@functools.lru_cache(maxsize=None)
+def _slice_probs(B1, B2, cleared_log):
+    """[(log of slice end, probability of factor found in slice)] for bounds B1, B2."""
+    slices = []
+    if B1 <= 1:
+        return slices
+
+    log_B1 = math.log(B1)
+    log_B2 = math.log(max(B2, B1))
+    log_per_slice = (MAX_FACTOR_LOG - cleared_log) / SLICES
+    for i in range(SLICES):
+        sta = cleared_log + i * log_per_slice
+        mid = cleared_log + (i + 0.5) * log_per_slice
+        end = cleared_log + (i + 1) * log_per_slice
+
+        prob_factor = math.log(end) - math.log(sta)
+        alpha = mid / log_B1
+        beta = mid / log_B2
+        prob = prob_stage1(alpha) + prob_stage2(alpha, beta)
+        slices.append((end, prob * prob_factor))
+    return slices
+
+
+def prob_pm1(n_bits, B1, B2, cleared=10**30):
+    """Probability of P-1 with B1, B2 finding a factor > cleared of a n_bits composite."""
+    max_log = n_bits * math.log(2) / 2
+    cleared_log = math.log(cleared)
+
+    total = 0
+    for end, prob in _slice_probs(int(B1), int(B2), cleared_log):
+        if end > max_log:
+            break
+        total += prob * (1 - total)
+    return total
+
+
+def prob_new_factor(n_bits, B1, B2, done_B1=0, done_B2=0, cleared=10**30):
+    """Probability of finding a factor with B1, B2 given no factor was found with done_B1, done_B2."""
+    done = prob_pm1(n_bits, done_B1, done_B2, cleared)
+    new = prob_pm1(n_bits, B1, B2, cleared)
+    return max(0.0, (new - done) / (1 - done))
@@ -2,22 +2,29 @@
 """Helper tool for reporting found factors to Studio Kamada."""
 
 import argparse
-import csv
 import datetime
 import json
 import math
+import multiprocessing
+import multiprocessing.connection
 import os
 import re
 import sys
 import time
-import urllib.parse
-import urllib.request
 
 from collections import defaultdict, Counter
 
 import sympy.ntheory
 
+import allcomp
+import b1_plan
 import ecm_resume
+import gpu_cost
+import log_index
+import pm1_yield
+import product_tree
+import residual_store
+import stdkmd
 
 
 def _get_argparser():
@@ -26,16 +33,48 @@ def _get_argparser():
 
     parser.add_argument('-a', '--allcomp', help='allcomp.txt filename', required=True)
     parser.add_argument('-l', '--logs', help='list of log files', nargs='*')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of processes to parse log files with')
+    parser.add_argument('--incremental', metavar='STATE',
+            help='state file to only parse new records of ecm-db json logs')
+    parser.add_argument('--log-index', metavar='DB',
+            help='SQLite factor index, only new runs of each log file are parsed')
     parser.add_argument('-d', '--factor-distribution',
             action='store_true',
             help='print distribution of found factor length')
     parser.add_argument('--split', help="Split allcomp.txt to runs", action='store_true')
+    parser.add_argument('--rank', action='store_true',
+            help="With --split sort batches by expected factors per GPU hour (requires --gpu-costs)")
+    parser.add_argument('--batch-B2', default="1e16",
+            help="Stage 2 bound for --rank")
+    parser.add_argument('--cleared-digits', type=int, default=30,
+            help="Factors below this many digits are assumed found already (by ECM) for --rank")
+    parser.add_argument('--diff', metavar='OLD_ALLCOMP',
+            help="Print changes from an older allcomp.txt")
     parser.add_argument('--rebatch',
             nargs="+",
             help="Load all residuals split to batches")
+    parser.add_argument('--batch-gcd', action='store_true',
+            help="With --rebatch find current composites dividing unmatched residuals")
+    parser.add_argument('--residual-db',
+            help="SQLite residual store, --rebatch files are ingested incrementally (--rank reads every file in it)")
+    parser.add_argument('--gpu-costs',
+            help="GPU cost table (see gpu_cost.py) to size --split/--rebatch batches")
+    parser.add_argument('--batch-B1', default="1e10",
+            help="B1 used to predict batch time with --gpu-costs")
+    parser.add_argument('--batch-hours', type=float, default=8,
+            help="Target wall time of each batch with --gpu-costs")
+    parser.add_argument('--target-B1',
+            help="With --rebatch extend residuals at every B1 to this B1 (requires --gpu-costs)")
     parser.add_argument('--submit', default=False,
             action='store_true',
             help='if factors should be submitted to https://stdkmd.net/')
+    parser.add_argument('--stdkmd-url', default=stdkmd.BASE_URL,
+            help='base url for checking and submitting factors')
+    parser.add_argument('--factor-cache', default='pm1_factor_cache.json',
+            help='json cache of factored f-1 values')
+    parser.add_argument('--factor-timeout', type=float, default=600,
+            help='seconds allowed to factor each f-1')
     parser.add_argument('-i', '--ignore', default=[], type=int, nargs='*',
             help='Factors to ignore')
 
@@ -46,7 +85,10 @@ def number_with_digits(n):
     return f"{n}<{len(str(n))}>"
 
 
-def split_to_batches(numbers):
+def split_to_batches(numbers, cost_model=None, B1=None, batch_seconds=None):
+    if cost_model:
+        return _split_to_batches_by_cost(numbers, cost_model, B1, batch_seconds)
+
     # Breakpoints related to kernel sizes
     BREAK_POINTS = list(reversed([128 * k - 8 for k in (10, 12, 14, 16, 20)]))
 
@@ -84,8 +126,142 @@ def split_to_batches(numbers):
     return groups
 
 
-def _split_numbers_and_output_batches(numbers):
-    groups = split_to_batches(numbers)
+def _split_to_batches_by_cost(numbers, cost_model, B1, batch_seconds):
+    """
+    Split numbers into batches minimizing predicted GPU time.
+
+    Numbers are grouped by smallest kernel, then a DP decides which runs of
+    adjacent kernel groups to merge (running the smaller numbers on the larger
+    kernel saves per batch overhead and partial launches). Each merged group is
+    cut into batches that finish in batch_seconds.
+    """
+    numbers = sorted(numbers)
+    if not numbers:
+        return []
+    assert all(1 < n < 2 ** 2048 for n in numbers)
+
+    by_kernel = defaultdict(list)
+    for n in numbers:
+        by_kernel[cost_model.kernel(n.bit_length())].append(n)
+    kernels = sorted(by_kernel)
+
+    # best[j] = (seconds, start) for kernel groups [0, j) with last merged group [start, j)
+    best = [(0, None)]
+    for j in range(1, len(kernels) + 1):
+        count = 0
+        options = []
+        for i in range(j - 1, -1, -1):
+            count += len(by_kernel[kernels[i]])
+            seconds = cost_model.seconds(count, kernels[j-1], B1, batch_seconds)
+            options.append((best[i][0] + seconds, i))
+        best.append(min(options))
+
+    segments = []
+    j = len(kernels)
+    while j > 0:
+        i = best[j][1]
+        segments.append((i, j))
+        j = i
+
+    groups = []
+    for i, j in reversed(segments):
+        kernel = kernels[j-1]
+        segment = [n for k in kernels[i:j] for n in by_kernel[k]]
+        size = cost_model.batch_size(kernel, B1, batch_seconds) if batch_seconds else len(segment)
+        for start in range(0, len(segment), size):
+            group = segment[start:start+size]
+            seconds = cost_model.seconds(len(group), kernel, B1)
+            print("new batch of {} {} to {} bits, {} bit kernel, predicted {:.0f} seconds".format(
+                len(group), group[0].bit_length(), group[-1].bit_length(), kernel, seconds))
+            groups.append(group)
+        print()
+
+    print(f"Predicted {best[-1][0] / 3600:.1f} GPU hours for {len(groups)} batches (B1={B1:,})")
+    return groups
+
+
+def _rank_numbers_and_output_batches(args, numbers):
+    """
+    Split numbers into batches sorted by expected factors per GPU hour.
+
+    The chance of a new factor with --batch-B1 / --batch-B2 (see pm1_yield.py)
+    is conditioned on the largest B1 in --residual-db, that run is assumed to
+    have had stage 2 with the same B2 / B1 ratio.
+    """
+    cost_args = _batch_cost_args(args)
+    assert cost_args, "--rank requires --gpu-costs"
+    cost_model = cost_args["cost_model"]
+    B1 = cost_args["B1"]
+    batch_seconds = cost_args["batch_seconds"]
+    B2 = int(float(args.batch_B2))
+    cleared = 10 ** args.cleared_digits
+
+    done_B1 = {}
+    if args.residual_db:
+        store = residual_store.ResidualStore(args.residual_db)
+        done_B1 = store.best_b1(method="P-1")
+        store.close()
+
+    probs = {}
+    skipped = 0
+    by_kernel = defaultdict(list)
+    for n in numbers:
+        bits = n.bit_length()
+        done = done_B1.get(residual_store.n_hash(n), 0)
+        if done >= B1:
+            skipped += 1
+            continue
+
+        key = (bits, done)
+        if key not in probs:
+            probs[key] = pm1_yield.prob_new_factor(bits, B1, B2, done, done * B2 // B1, cleared)
+        by_kernel[cost_model.kernel(bits)].append((probs[key], n))
+
+    if skipped:
+        print(f"Skipping {skipped} numbers with residuals at B1 >= {B1:,}")
+
+    # (factors per hour, expected factors, seconds, kernel, numbers)
+    batches = []
+    for kernel, ranked in by_kernel.items():
+        # Same kernel means same cost per number, sort by probability.
+        ranked.sort(reverse=True)
+        size = cost_model.batch_size(kernel, B1, batch_seconds)
+        for start in range(0, len(ranked), size):
+            group = ranked[start:start+size]
+            seconds = cost_model.seconds(len(group), kernel, B1) + cost_model.stage2 * len(group)
+            expected = sum(prob for prob, _ in group)
+            batches.append((expected / seconds * 3600, expected, seconds, kernel, sorted(n for _, n in group)))
+    batches.sort(key=lambda b: -b[0])
+
+    date = datetime.datetime.now().strftime("%Y%m%d")
+    total_hours = total_factors = 0
+    for i, (rate, expected, seconds, kernel, group) in enumerate(batches):
+        total_hours += seconds / 3600
+        total_factors += expected
+        max_bits = group[-1].bit_length()
+        fn = f"pm1_stdkmd_{date}_rank_{i:02d}_{max_bits}.txt"
+        print(f"{fn!r} {len(group)} numbers, {kernel} bit kernel, {expected:.2f} factors in "
+              f"{seconds / 3600:.1f} hours = {rate:.3f} / GPU hour "
+              f"(total {total_factors:.1f} in {total_hours:.1f} hours)")
+        assert not os.path.exists(fn)
+        with open(fn, "w") as f:
+            for number in group:
+                f.write(str(number) + "\n")
+
+
+def _batch_cost_args(args):
+    """split_to_batches() keyword arguments from --gpu-costs."""
+    if not args.gpu_costs:
+        return {}
+    return {
+        "cost_model": gpu_cost.GpuCostModel.from_file(args.gpu_costs),
+        "B1": int(float(args.batch_B1)),
+        "batch_seconds": args.batch_hours * 3600,
+    }
+
+
+def _split_numbers_and_output_batches(numbers, **cost_args):
+    groups = split_to_batches(numbers, **cost_args)
 
     date = datetime.datetime.now().strftime("%Y%m%d")
     for i, group in enumerate(groups):
@@ -99,8 +275,7 @@ def _split_numbers_and_output_batches(numbers):
 
 
 def _validate_residual(parsed):
-    keys = ("METHOD", "N", "B1", "X", "X0", "CHECKSUM")
-    return all(key in parsed for key in keys)
+    return all(key in parsed for key in residual_store.RESIDUAL_KEYS)
 
 
 def update_resume(parsed, line, factor):
@@ -133,22 +308,28 @@ def update_resume(parsed, line, factor):
     return line
 
 
-def _rebatch_residuals(args, lookup):
-    """
-    1. Load all residuals
-        Drop all but largest B1
-    2. Figure out for each N in residual if it has new factors
-        N should appear in allcomp_2023.txt
-        Get factors from newest allcomp_<DATE>.txt
-    3. Split up residuals by batch size
-        When B1 doesn't match ask for CPU eval?
-    """
+def _print_allcomp_diff(old_fn, lookup):
+    """Summarize changes from old_fn to lookup and list new factors."""
+    _, old_lookup = allcomp.load_allcomp(old_fn)
 
-    # 1. Load all residuals
+    kinds = Counter()
+    for change in allcomp.diff_allcomp(old_lookup, lookup):
+        kinds[change.kind] += 1
+        if change.kind == "shrank":
+            print(f"\t{change.label:12} factor {number_with_digits(change.factor)}")
+
+    print()
+    print(f"Comparing with {old_fn!r}")
+    for kind, count in sorted(kinds.items()):
+        print(f"\t{kind:10} {count}")
+
+
+def _load_residuals(fns):
+    """Load resume lines from fns keeping the largest B1 line for each N."""
     loaded = 0
     residuals = {}
 
-    for fn in args.rebatch:
+    for fn in fns:
         with open(fn) as f:
             for i, line in enumerate(f):
                 line = line.strip()
@@ -156,7 +337,7 @@ def _rebatch_residuals(args, lookup):
                     continue
 
                 loaded += 1
-                parsed = ecm_resume.parse_resume(line)
+                parsed = ecm_resume.ResumeLine(line)
                 if not _validate_residual(parsed):
                     print(f"Bad residual line {i} in {fn}: {line[:40]}...")
                     exit(1)
@@ -165,7 +346,7 @@ def _rebatch_residuals(args, lookup):
 
                 # This likely happens when a stage 1 factor was found.
                 # Maybe the number still needs to be factored.
-                if parsed['X'] == 0:
+                if parsed.is_zero('X'):
                     # Not sure why this happened but need to drop
                     print(f"\tDropping line {i} in {fn}: X=0 N={str(n)[:10]}...")
                     continue
@@ -178,13 +359,155 @@ def _rebatch_residuals(args, lookup):
                 if update:
                     residuals[n] = (parsed, line)
 
+    return loaded, residuals
+
+
+def _load_residuals_from_store(db_fn, fns, lookup):
+    """Ingest new lines from fns then load the largest B1 line for each N from fns."""
+    store = residual_store.ResidualStore(db_fn)
+    for fn in fns:
+        added = store.ingest(fn, lookup)
+        print(f"\tIngested {added} new residuals from {fn!r}")
+
+    loaded = store.count(fns)
+    residuals = {}
+    for line in store.read_lines(store.best(files=fns)):
+        parsed = ecm_resume.ResumeLine(line)
+        if not _validate_residual(parsed):
+            print(f"Bad residual line in {db_fn}: {line[:40]}...")
+            exit(1)
+
+        n = parsed['N']
+        assert n not in residuals, n
+        residuals[n] = (parsed, line)
+
+    store.close()
+    return loaded, residuals
+
+
+def _b1_str(B1):
+    """4000000000 => "4e9" for filenames."""
+    digits = str(B1).rstrip("0")
+    zeros = len(str(B1)) - len(digits)
+    return f"{digits}e{zeros}" if zeros else digits
+
+
+def _write_harmonized_batches(args, residuals, to_run, folder):
+    """
+    Extend residuals at every B1 to --target-B1 (see b1_plan.py).
+
+    Batches of a step that merges into a higher B1 level are cut along the
+    batches of that level so each save file is appended to the resume file of
+    exactly one later batch.
+    """
+    cost_args = _batch_cost_args(args)
+    assert cost_args, "--target-B1 requires --gpu-costs"
+    cost_model = cost_args["cost_model"]
+    batch_seconds = cost_args["batch_seconds"]
+    target = int(float(args.target_B1))
+
+    by_B1 = defaultdict(list)
+    for n in to_run:
+        by_B1[residuals[n][0]["B1"]].append(n)
+    done = sum(len(by_B1.pop(B1)) for B1 in list(by_B1) if B1 >= target)
+    print(f"{done} residuals already have B1 >= {target:,}")
+    if not by_B1:
+        return
+
+    counts = {B1: Counter(cost_model.kernel(n.bit_length()) for n in ns) for B1, ns in by_B1.items()}
+    seconds, parents = b1_plan.plan_extensions(counts, target, cost_model, batch_seconds)
+    print()
+    print(f"Extension plan to B1={target:,}, predicted {seconds / 3600:.1f} GPU hours")
+    for B1, parent in sorted(parents.items()):
+        print(f"\t{B1=:,} x {len(by_B1[B1])} => {parent:,}")
+    print()
+
+    # Numbers at each level including those merged from lower levels.
+    numbers = {B1: list(ns) for B1, ns in by_B1.items()}
+    for B1 in sorted(parents):
+        if parents[B1] != target:
+            numbers[parents[B1]].extend(numbers[B1])
+
+    # Cut batches from the highest level down: [(group, index of parent batch)]
+    batches = {}
+    for B1 in sorted(parents, reverse=True):
+        parent = parents[B1]
+        if parent == target:
+            groups = split_to_batches(numbers[B1], cost_model, target - B1, batch_seconds)
+            batches[B1] = [(group, None) for group in groups]
+            continue
+
+        members = set(numbers[B1])
+        batches[B1] = []
+        for p, (parent_group, _) in enumerate(batches[parent]):
+            sub = [n for n in parent_group if n in members]
+            if sub:
+                groups = split_to_batches(sub, cost_model, parent - B1, batch_seconds)
+                batches[B1].extend((group, p) for group in groups)
+
+    def batch_name(B1, i):
+        return os.path.join(folder, f"pm1_stdkmd_{_b1_str(B1)}_to_{_b1_str(parents[B1])}_batch_{i:02d}")
+
+    commands = []
+    for B1 in sorted(parents):
+        end = parents[B1]
+        own = set(by_B1[B1])
+        for i, (group, _) in enumerate(batches[B1]):
+            name = batch_name(B1, i)
+            path = name + ".resume.txt"
+            lines = [residuals[n][1] for n in group if n in own]
+
+            # Save files of lower levels that merge into this batch
+            for child, parent in sorted(parents.items()):
+                if parent == B1:
+                    for j, (_, p) in enumerate(batches[child]):
+                        if p == i:
+                            commands.append(f"cat {batch_name(child, j)}.save.txt >> {path}")
+            commands.append(f"./ecm -v -gpu -pm1 -resume {path} -save {name}.save.txt {end} 0 | tee -a {name}.log")
+
+            if not args.submit:
+                print(f"Would write {len(lines)} of {len(group)} rows to {path!r} (with --submit)")
+            else:
+                print(f"Writing {len(lines)} of {len(group)} rows to {path!r}")
+                assert not os.path.exists(path)
+                with open(path, "w") as f:
+                    for line in lines:
+                        f.write(line)
+                        f.write("\n")
+
+    print()
+    print("Run in order")
+    for command in commands:
+        print("\t" + command)
+    if args.submit:
+        with open(os.path.join(folder, "plan.sh"), "w") as f:
+            f.write("".join(command + "\n" for command in commands))
+
+
+def _rebatch_residuals(args, lookup):
+    """
+    1. Load all residuals
+        Drop all but largest B1
+    2. Figure out for each N in residual if it has new factors
+        N should appear in allcomp_2023.txt
+        Get factors from newest allcomp_<DATE>.txt
+    3. Split up residuals by batch size
+        When B1 doesn't match ask for CPU eval?
+    """
+
+    # 1. Load all residuals
+    if args.residual_db:
+        loaded, residuals = _load_residuals_from_store(args.residual_db, args.rebatch, lookup)
+    else:
+        loaded, residuals = _load_residuals(args.rebatch)
+
     print()
     print(f"Loaded {loaded} residuals, {len(residuals)} unique")
 
     # 2. Load old and newer allcomp.txt
     OG_ALLCOMP = "allcomp_2023.txt"
     assert args.allcomp != OG_ALLCOMP
-    _, og_lookup = load_allcomp(OG_ALLCOMP)
+    _, og_lookup = allcomp.load_allcomp(OG_ALLCOMP)
     print(f"Allcomp was {len(og_lookup)} is now {len(lookup)}")
     print()
 
@@ -192,14 +515,10 @@ def _rebatch_residuals(args, lookup):
         for B1, count in sorted(Counter(p['B1'] for p,l in residuals.values()).items()):
             print(f"\t{B1=:,} x {count}")
 
-    LABEL_KEY = '#"Label"'
-
-    # reindex lookup and og_lookup by "Label"+"N"
-    def new_label(row):
-        return row[LABEL_KEY].replace('"', '') + "_" + row["N"]
+    LABEL_KEY = allcomp.LABEL_KEY
 
-    lookup_label = {new_label(row): row for row in lookup.values()}
-    og_lookup_label = {new_label(row): row for row in og_lookup.values()}
+    # Changes from og_lookup to lookup by "Label"+"N"
+    changes = {c.old: c for c in allcomp.diff_allcomp(og_lookup, lookup) if c.old}
 
     to_run = []
 
@@ -212,9 +531,33 @@ def _rebatch_residuals(args, lookup):
     factored_partial = 0
     # Not Present in either, will have to do a search or something
     missing = 0
+    # Not in lookup and not matched by label (see --batch-gcd)
+    unresolved = []
 
     add_residuals = {}
 
+    def add_shrunk_residual(n, parsed, line, n_new):
+        # Update resume line removing the factor n / n_new.
+        new_line = update_resume(parsed, line, n // n_new)
+        new_parsed = ecm_resume.parse_resume(new_line)
+        assert new_parsed["N"] == n_new
+        assert 1 < new_parsed["X"] < n_new
+
+        assert n_new in lookup
+        if n_new in residuals:
+            # Residuals for both the old and new number have to merge
+            if residuals[n_new][0]['B1'] < parsed['B1']:
+                # More P-1 complete for old number, Merge
+                residuals[n_new] = (new_parsed, new_line)
+        elif n_new in add_residuals:
+            # Another residual (e.g. from batch GCD) already shrank to n_new, keep the larger B1
+            if add_residuals[n_new][0]['B1'] < parsed['B1']:
+                add_residuals[n_new] = (new_parsed, new_line)
+        else:
+            # Technically we might need to merge again but very few numbers.
+            add_residuals[n_new] = (new_parsed, new_line)
+            to_run.append(n_new)
+
     # Update residuals, possibly removing a factor or dismissing if factored.
     for n, (parsed, line) in residuals.items():
         if n in lookup:
@@ -224,33 +567,29 @@ def _rebatch_residuals(args, lookup):
 
         if n in og_lookup:
             # Lookup label and check if factored partially or completely
-            label = new_label(og_lookup[n])
-            if label not in lookup_label:
+            change = changes[n]
+            if change.kind == "removed":
                 factored_completely += 1
+                unresolved.append(n)
                 continue
             else:
+                assert change.kind == "shrank", change
                 factored_partial += 1
-                n_new = int(lookup_label[label]["CompositeNumber"])
-                f, mod = divmod(n, n_new)
-                assert mod == 0, (label, n)
-
-                # Update resume line removing factor of f.
-                new_line = update_resume(parsed, line, f)
-                new_parsed = ecm_resume.parse_resume(new_line)
-                assert new_parsed["N"] == n_new
-                assert 1 < new_parsed["X"] < n_new
-
-                assert n_new in lookup
-                if n_new in residuals:
-                    # Residuals for both the old and new number have to merge
-                    if residuals[n_new][0]['B1'] < parsed['B1']:
-                        # More P-1 complete for old number, Merge
-                        residuals[n_new] = (new_parsed, new_line)
-                else:
-                    # Technically we might need to merge again but very few numbers.
-                    add_residuals[n_new] = (new_parsed, new_line)
-                    to_run.append(n_new)
-
+                add_shrunk_residual(n, parsed, line, change.new)
+        else:
+            missing += 1
+            unresolved.append(n)
+
+    # Find current composites dividing residuals that label matching missed.
+    recovered = 0
+    if args.batch_gcd and unresolved:
+        divisors = product_tree.find_divisors(unresolved, list(lookup))
+        for n, cofactors in divisors.items():
+            parsed, line = residuals[n]
+            for n_new in cofactors:
+                recovered += 1
+                add_shrunk_residual(n, parsed, line, n_new)
+        print(f"Batch GCD recovered {recovered} residuals from {len(unresolved)} unmatched")
 
     # Add any residuals which had a factored removed
     for k, v in add_residuals.items():
@@ -263,6 +602,7 @@ def _rebatch_residuals(args, lookup):
         for B1, count in sorted(B1_to_run.items()):
             print(f"\t{B1=:,} x {count}")
 
+    if not args.target_B1:
         # select all the same B1 so that all B1 in resume match.
         SELECT_B1 = 4 * 10 ** 9
         print(f"Selecting only residuals with B1={SELECT_B1:,}")
@@ -274,8 +614,8 @@ def _rebatch_residuals(args, lookup):
 
     print()
     print(f"Comparing with {OG_ALLCOMP!r}")
-    print("\t{} the same, {} with a new factor, {} completely factored".format(
-        same, factored_partial, factored_completely))
+    print("\t{} the same, {} with a new factor, {} completely factored, {} missing".format(
+        same, factored_partial, factored_completely, missing))
 
     print()
     print(f"{len(to_run)} numbers with residuals")
@@ -320,14 +660,18 @@ def _rebatch_residuals(args, lookup):
 
 
     # 3. Split to_run by batch
-    groups = split_to_batches(to_run)
-
     date = datetime.datetime.now().strftime("%Y%m%d")
     folder = f"resumes_{date}"
     if args.submit:
         assert not os.path.exists(folder)
         os.mkdir(folder)
 
+    if args.target_B1:
+        _write_harmonized_batches(args, residuals, to_run, folder)
+        return
+
+    groups = split_to_batches(to_run, **_batch_cost_args(args))
+
     for i, group in enumerate(groups):
         max_bits = group[-1].bit_length()
         path = os.path.join(folder, f"pm1_stdkmd_batch_{i:02d}_{max_bits}.resume.txt")
@@ -343,105 +687,338 @@ def _rebatch_residuals(args, lookup):
 
 
 
-def load_allcomp(fn):
-    numbers = []
-    lookup = {}
-    with open(fn) as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            n = int(row["CompositeNumber"])
-            lookup[n] = row
-            numbers.append(n)
+# Lines that indicate the start / end of a run and found factors
+LOG_START_RE = re.compile('^(?:Resuming ... residue|Input number is|GMP-ECM|v{10})')
+LOG_END_RE = re.compile(r'Step 2 took|^\^{10}')
+FACTOR_FOUND_RE = re.compile("Factor found in step .: ([0-9]+)$")
+USING_RE = re.compile("Using B1=(?:[0-9]+-)?([0-9]+), B2=([0-9]+)")
+LOG_METHOD_RE = re.compile(r"^GMP-ECM .*\[(ECM|P-1|P\+1)\]$")
 
-    numbers.sort()
-    assert len(numbers) > 25000, len(numbers)
-    return numbers, lookup
 
+# Split large log files into pieces of about this size for --jobs
+LOG_CHUNK_SIZE = 64 * 1024 ** 2
 
-def get_logs(log_fns):
-    logs = {}
-    for fn in log_fns:
-        with open(fn) as f:
-            file_logs = [l.strip() for l in f.readlines()]
-        if file_logs:
-            logs[fn] = file_logs
 
-    return logs
+def _iter_lines(fn, start, end):
+    """Yield (offset, next offset, decoded line) from fn between byte offsets [start, end)."""
+    with open(fn, "rb") as f:
+        f.seek(start)
+        pos = start
+        for raw in f:
+            if end is not None and pos >= end:
+                break
+            yield pos, pos + len(raw), raw.decode()
+            pos += len(raw)
+
+
+def iter_log_runs(fn, start=0, end=None):
+    """
+    Stream a log file yielding one ECM run (list of lines) at a time.
+
+    start and end (byte offsets) limit parsing to part of the file, start must
+    be a run boundary (see _find_run_boundary).
+    """
+    for _, _, run in iter_log_run_spans(fn, start, end):
+        yield run
+
+
+def iter_log_run_spans(fn, start=0, end=None):
+    """Same as iter_log_runs but yields (offset, length, run)."""
+    if fn.endswith("json.log"):
+        # Logs from ecm-db, each line is a [wu, result] record.
+        for pos, next_pos, line in _iter_lines(fn, start, end):
+            if not line.isspace():
+                yield pos, next_pos - pos, json.loads(line)
+        return
+
+    grouped = []
+    run_start = run_end = start
+    for pos, next_pos, line in _iter_lines(fn, start, end):
+        line = line.strip()
+        is_start = LOG_START_RE.match(line) is not None
+
+        # First line should be start line (or '^^^^^^' at a run boundary)
+        assert grouped or is_start or start > 0, (grouped, line)
+
+        # If new start, one of the recent lines should be an end
+        if grouped and (len(grouped) >= 5 and is_start or line.startswith('^^^^^^')):
+            # DEBUG Truncated inputs
+            if False:
+                if not grouped[0].startswith("vvvvv"):
+                    # Step 2 took, Factor found, Found Prime factor, cofactor
+                    if not any(LOG_END_RE.search(prev) for prev in grouped[-4:]):
+                        print("TRUNCATED INPUT")
+                        for g in grouped:
+                            out = g.replace("\t", "  ").strip()
+                            print(f"\t|{out:81}|")
+                        print("*" * 80)
 
+            yield run_start, run_end - run_start, grouped
+            grouped = []
+            run_start = pos
 
-def parse_json_logs(logs):
-    """Parse logs from ecm-db."""
-    return [json.loads(line) for line in logs if not line.isspace()]
+        grouped.append(line)
+        run_end = next_pos
 
-def parse_logs(all_logs):
-    """Parse logs into per-ECM output."""
+    if grouped:
+        yield run_start, run_end - run_start, grouped
 
+
+def _find_run_boundary(f, offset, is_json):
+    """
+    Find the first offset >= offset where iter_log_runs always starts a new run.
+
+    That is a '^^^^^^' line or a start line with no start line in the previous
+    four lines (so the current run has at least five lines).
+    """
+    f.seek(offset)
+    if offset:
+        # Skip partial line
+        f.readline()
+    pos = f.tell()
+
+    since_start = 0
+    for raw in f:
+        if is_json:
+            return pos
+
+        line = raw.decode().strip()
+        if line.startswith('^^^^^^'):
+            return pos
+
+        is_start = LOG_START_RE.match(line) is not None
+        if is_start and since_start >= 4:
+            return pos
+
+        since_start = 0 if is_start else since_start + 1
+        pos += len(raw)
+
+    return pos
+
+
+def _log_chunks(fn):
+    """Split fn into (fn, start, end) pieces that can be parsed independently."""
+    size = os.path.getsize(fn)
+    is_json = fn.endswith("json.log")
+
+    offsets = [0]
+    with open(fn, "rb") as f:
+        while offsets[-1] + LOG_CHUNK_SIZE < size:
+            boundary = _find_run_boundary(f, offsets[-1] + LOG_CHUNK_SIZE, is_json)
+            if boundary >= size:
+                break
+            offsets.append(boundary)
+
+    offsets.append(size)
+    return [(fn, a, b) for a, b in zip(offsets, offsets[1:])]
+
+
+def _run_factors(run, stats):
+    """Yield factors found in one run, stats is updated with the number of 'lines'."""
+    if len(run) == 2 and isinstance(run[0], dict):
+        # json log.
+        wu, result = run
+        stats["lines"] += result['output'].count('\n')
+        yield from result['factors']
+    else:
+        stats["lines"] += len(run)
+        for line in run:
+            match = FACTOR_FOUND_RE.search(line)
+            if match:
+                f = int(match.group(1))
+                assert 2 <= f <= 10 ** 65, f
+                yield f
+
+
+def _run_parameters(run):
+    """(method, B1, B2) from the "Using" line of a run, None if not present."""
+    if len(run) == 2 and isinstance(run[0], dict):
+        run = run[1]['output'].splitlines()
+
+    method = b1 = b2 = None
+    for line in run:
+        match = LOG_METHOD_RE.search(line)
+        if match and method is None:
+            method = match.group(1)
+        match = USING_RE.match(line.strip())
+        if match:
+            b1, b2 = int(match.group(1)), int(match.group(2))
+            if method is None:
+                method = "ECM" if "sigma=" in line else "P-1"
+            break
+    return method, b1, b2
+
+
+def iter_log_factors(fn, stats, start=0, end=None):
+    """
+    Stream (factor, run) for every factor found in a log file.
+
+    Only the current run is kept in memory. stats (a Counter) is updated with
+    the number of 'runs' and 'lines' seen.
+    """
+    for run in iter_log_runs(fn, start, end):
+        stats["runs"] += 1
+        for f in _run_factors(run, stats):
+            yield f, run
+
+
+def _parse_log_chunk(chunk):
+    """Worker for parse_logs, returns ({factor: [runs]}, stats) for one chunk."""
+    fn, start, end = chunk
     factors = defaultdict(list)
+    stats = Counter()
+    for f, run in iter_log_factors(fn, stats, start, end):
+        factors[f].append(run)
+    return factors, stats
 
-    # Regular Expression that indicate start of log
-    starts = (
-        re.compile('^Resuming ... residue'),
-        re.compile('^Input number is'),
-        re.compile('^GMP-ECM'),
-        re.compile('^v{10}'),
-    )
-    ends = (
-        re.compile('Step 2 took'),
-        re.compile(r'^\^{10}'),
-    )
 
-    groups = []
-    for fn, logs in all_logs.items():
-        if fn.endswith("json.log"):
-            groups.extend(parse_json_logs(logs))
-            continue
+def _load_json_state(state_fn):
+    if os.path.exists(state_fn):
+        with open(state_fn) as f:
+            return json.load(f)
+    return {"files": {}, "factors": {}}
 
-        grouped = []
-        for i, line in enumerate(logs):
-            is_start = line.startswith(("R", "I", "G", "v")) and any(re.search(start, line) for start in starts)
-
-            # First line should be start line
-            assert len(grouped) > 0 or is_start, (grouped, line)
-
-            # If new start, one of the recent lines should be an end
-            if len(grouped) >= 5 and is_start or line.startswith('^^^^^^'):
-                # DEBUG Truncated inputs
-                if False:
-                    if not grouped[0].startswith("vvvvv"):
-                        # Step 2 took, Factor found, Found Prime factor, cofactor
-                        if not any(re.search(end, prev) for end in ends for prev in grouped[-4:]):
-                            print("TRUNCATED INPUT")
-                            for g in grouped:
-                                out = g.replace("\t", "  ").strip()
-                                print(f"\t|{out:81}|")
-                            print("*" * 80)
-
-                groups.append(grouped)
-                grouped = []
-
-            grouped.append(line)
-
-        if grouped:
-            groups.append(grouped)
-
-    total_lines = 0
-    for group in groups:
-        if len(group) == 2 and isinstance(group[0], dict):
-            # json log.
-            wu, result = group
-            for f in result['factors']:
-                factors[f].append(group)
-            total_lines += result['output'].count('\n')
-        else:
-            total_lines += len(group)
-            for line in group:
-                match = re.search("Factor found in step .: ([0-9]+)$", line)
-                if match:
-                    f = int(match.group(1))
-                    assert 2 <= f <= 10 ** 65, f
-                    factors[f].append(group)
 
-    print("\t", len(groups), "ecm runs", total_lines, "lines")
+def _save_json_state(state_fn, state):
+    with open(state_fn + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_fn + ".tmp", state_fn)
+
+
+def parse_json_logs_incremental(json_fns, state_fn, stats):
+    """
+    Parse only records appended to ecm-db json logs since the last run.
+
+    state_fn (json) keeps the inode and byte offset parsed for each file plus
+    a persistent index of {factor: [{"file", "offset", "record"}]}.
+    Returns {factor: [records]} for all indexed records of json_fns.
+    """
+    state = _load_json_state(state_fn)
+    index = state["factors"]
+
+    paths = []
+    for fn in json_fns:
+        path = os.path.abspath(fn)
+        paths.append(path)
+        st = os.stat(path)
+
+        entry = state["files"].get(path)
+        offset = 0
+        if entry and entry["inode"] == st.st_ino and entry["offset"] <= st.st_size:
+            offset = entry["offset"]
+        elif entry:
+            # File was replaced or truncated, drop its records.
+            for f in list(index):
+                index[f] = [r for r in index[f] if r["file"] != path]
+                if not index[f]:
+                    del index[f]
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    # Partial record still being written
+                    break
+
+                record_offset = offset
+                offset += len(raw)
+                if raw.isspace():
+                    continue
+
+                record = json.loads(raw)
+                wu, result = record
+                stats["runs"] += 1
+                stats["lines"] += result['output'].count('\n')
+                for factor in result['factors']:
+                    index.setdefault(str(factor), []).append(
+                        {"file": path, "offset": record_offset, "record": record})
+
+        state["files"][path] = {"inode": st.st_ino, "offset": offset}
+
+    _save_json_state(state_fn, state)
+
+    factors = defaultdict(list)
+    for f, records in index.items():
+        for r in records:
+            if r["file"] in paths:
+                factors[int(f)].append(r["record"])
+                stats["indexed"] += 1
+    return factors
+
+
+def index_logs(log_fns, index_fn, stats):
+    """
+    Update the factor index (see log_index.py) with runs appended to log_fns.
+
+    Returns {factor: [runs]} for log_fns, runs are read back from the index.
+    """
+    index = log_index.LogIndex(index_fn)
+    for fn in log_fns:
+        start, end = index.pending(fn)
+        entries = []
+        last_run = start
+        for offset, length, run in iter_log_run_spans(fn, start, end):
+            stats["runs"] += 1
+            last_run = offset
+            for f in _run_factors(run, stats):
+                entries.append((f, offset, length, *_run_parameters(run)))
+
+        # The last run of a text log might not be finished, it's parsed again next time.
+        index.add(fn, entries, end if fn.endswith("json.log") else last_run)
+
+    factors = defaultdict(list)
+    for f, path, offset, length in index.factors(log_fns):
+        factors[f].append(log_index.read_run(path, offset, length))
+        stats["indexed"] += 1
+    index.close()
+
+    print(f"{len(log_fns)} log files had {stats['runs']} new ecm runs, "
+          f"{stats['indexed']} factor runs indexed")
+    return factors
+
+
+def parse_logs(log_fns, jobs=1, state_fn=None, index_fn=None):
+    """
+    Parse log files into {factor: [runs]}.
+
+    With jobs > 1 files (and pieces of large files) are parsed in a process pool,
+    results are merged in file order so output matches the serial path.
+
+    With state_fn ecm-db json logs are parsed incrementally, see
+    parse_json_logs_incremental.
+
+    With index_fn all logs are indexed incrementally, see index_logs.
+    """
+    factors = defaultdict(list)
+    stats = Counter()
+
+    if index_fn:
+        return index_logs(log_fns, index_fn, stats)
+
+    if state_fn:
+        json_fns = [fn for fn in log_fns if fn.endswith("json.log")]
+        log_fns = [fn for fn in log_fns if not fn.endswith("json.log")]
+        if json_fns:
+            factors.update(parse_json_logs_incremental(json_fns, state_fn, stats))
+            print(f"{len(json_fns)} json logs had {stats['runs']} new records, "
+                  f"{stats['indexed']} factor records indexed")
+        if not log_fns:
+            return factors
+
+    if jobs > 1:
+        chunks = [chunk for fn in log_fns for chunk in _log_chunks(fn)]
+        with multiprocessing.Pool(processes=jobs) as pool:
+            for chunk_factors, chunk_stats in pool.imap(_parse_log_chunk, chunks):
+                for f, runs in chunk_factors.items():
+                    factors[f].extend(runs)
+                stats.update(chunk_stats)
+    else:
+        for fn in log_fns:
+            for f, run in iter_log_factors(fn, stats):
+                factors[f].append(run)
+
+    assert stats["runs"] or stats["indexed"], "No logs found"
+    print(f"{len(log_fns)} log files contained {stats['runs']} ecm runs, {stats['lines']} lines")
 
     return factors
 
@@ -468,7 +1045,123 @@ def _get_contribution_parameters(classification, logs):
     }
 
 
-def _handle_factor(f, n, submit, row, log):
+# Results of _run_with_timeouts for items that didn't finish
+TIMED_OUT = "timed out"
+CRASHED = "worker crashed"
+
+
+def _factor_pm1(f):
+    """Factor f-1, the slow part of _handle_factor."""
+    return sorted((int(p), int(e)) for p, e in sympy.ntheory.factorint(f-1).items())
+
+
+def _cofactor_prime(f, n):
+    """If the remaining cofactor n/f is prime (None if too large to test quickly)."""
+    cf = n // f
+    if len(str(cf)) < 145:
+        return bool(sympy.isprime(cf))
+    return None
+
+
+def _pipe_worker(func, item, conn):
+    conn.send(func(*item))
+    conn.close()
+
+
+def _run_with_timeouts(func, items, jobs, timeout):
+    """
+    Run func(*item) for each item in its own process, at most jobs at once.
+
+    Returns {item: result}, result is TIMED_OUT if func took longer than timeout
+    seconds or CRASHED if the worker died without a result.
+    """
+    results = {}
+    pending = list(items)
+    running = []
+    while pending or running:
+        while pending and len(running) < jobs:
+            item = pending.pop(0)
+            recv, send = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_pipe_worker, args=(func, item, send))
+            process.start()
+            send.close()
+            running.append((item, process, recv, time.monotonic()))
+
+        ready = multiprocessing.connection.wait([recv for _, _, recv, _ in running], timeout=0.1)
+
+        still_running = []
+        for item, process, recv, start in running:
+            if recv in ready:
+                try:
+                    results[item] = recv.recv()
+                except EOFError:
+                    # Worker died
+                    results[item] = CRASHED
+                process.join()
+            elif time.monotonic() - start > timeout:
+                process.terminate()
+                process.join()
+                results[item] = TIMED_OUT
+            else:
+                still_running.append((item, process, recv, start))
+        running = still_running
+
+    return results
+
+
+def _factor_pm1_all(pairs, cache_fn, jobs, timeout):
+    """
+    Factor f-1 for all (f, n) pairs in a process pool with a per f timeout.
+
+    Results are saved in cache_fn (json keyed by f) so reruns are instant, a
+    known f dividing a different n only needs the quick cofactor test.
+    Returns {(f, n): (factors, cofactor_prime)} (TIMED_OUT or CRASHED on failure).
+    """
+    cache = {}
+    if cache_fn and os.path.exists(cache_fn):
+        with open(cache_fn) as f:
+            cache = json.load(f)
+
+    fs = sorted({f for f, n in pairs})
+    todo = [(f,) for f in fs if str(f) not in cache]
+    failed = {}
+    if todo:
+        print(f"Factoring {len(todo)} P-1 values ({len(fs) - len(todo)} cached)")
+        computed = _run_with_timeouts(_factor_pm1, todo, jobs, timeout)
+        for (f,), result in computed.items():
+            if result in (TIMED_OUT, CRASHED):
+                failed[f] = result
+            else:
+                cache[str(f)] = {"p_minus_1": result, "cofactor_prime": {}}
+
+    results = {}
+    updated = bool(todo)
+    for f, n in pairs:
+        if f in failed:
+            results[(f, n)] = failed[f]
+            continue
+
+        entry = cache[str(f)]
+        if str(n) not in entry["cofactor_prime"]:
+            entry["cofactor_prime"][str(n)] = _cofactor_prime(f, n)
+            updated = True
+        factors = [tuple(pe) for pe in entry["p_minus_1"]]
+        results[(f, n)] = (factors, entry["cofactor_prime"][str(n)])
+
+    if cache_fn and updated:
+        with open(cache_fn + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_fn + ".tmp", cache_fn)
+
+    return results
+
+
+def _handle_factor(f, n, row, pm1):
+    """
+    Print factor details, returns classification e.g. "94447_297".
+
+    pm1 is (factors of f-1, cofactor_prime) or TIMED_OUT / CRASHED from _factor_pm1_all.
+    """
     assert n % f == 0
     expr = row["Expression"]
     label = row['#"Label"']
@@ -476,61 +1169,71 @@ def _handle_factor(f, n, submit, row, log):
     classification = f"{label}_{power}"
     contribute_url = f"https://stdkmd.net/nrr/c.cgi?q={classification}"
     details_url = f"https://stdkmd.net/nrr/cont/{label[0]}/{label}.htm#N{power}"
-    factors = sorted(sympy.ntheory.factorint(f-1).items())
-    minB2 = max(p for p, e in factors)
-    minB1 = max(p ** e for p, e in factors if p != minB2)
     print(f"\t{f} divides {expr}")
     print(f"\t{contribute_url:45} {details_url}")
+
+    if pm1 in (TIMED_OUT, CRASHED):
+        print(f"\tP-1 = ? ({pm1} factoring)")
+        print()
+        return classification
+
+    factors, cofactor_prime = pm1
+    minB2 = max(p for p, e in factors)
+    minB1 = max(p ** e for p, e in factors if p != minB2)
     print("\tP-1 =", " * ".join(f"{p}" if e == 1 else f"{p}^{e}" for p, e in factors))
     print("\tRequires: B1 >= {:9,} B2 >= {:9,} || B1 >= 1e{}, B2 >= 1e{}".format(
         minB1, minB2, len(str(minB1)), len(str(minB2))))
 
     # Small remaining composite number, suitable for GNFS
     cf = n // f
-    if len(str(cf)) < 145 and not sympy.isprime(cf):
+    if cofactor_prime is False:
         print(f"\t{len(str(cf))}-digit composite remaining")
         print("\t\t", cf)
     print()
 
-    # Submit numbers
-    if submit:
-        time.sleep(0.1)
-        page = urllib.request.urlopen(contribute_url)
-        assert page.code == 200, page.code
-        data = page.read().decode()
-        assert len(data) > 2000, len(data)
-
-        if str(f) in data or "This number has been factored." in data:
-            print("ALREADY KNOWN")
-            return
-        if "Please wait until the factor table" in data:
-            print("WAITING ON factor table UPDATE")
-            return
+    return classification
 
+
+def _submit_factors(to_submit, args):
+    """
+    Check which factors stdkmd already knows (concurrently) then submit the rest
+    after one confirmation.
+
+    to_submit is a list of (factor, classification, log)
+    """
+    factors = [(f, classification, _get_contribution_parameters(classification, log))
+               for f, classification, log in to_submit]
+    logs = {f: log for f, _, log in to_submit}
+
+    def confirm(new):
+        for f, classification, _ in new:
+            print("-"*80)
+            print(f"{classification} {f}")
+            for line in logs[f]:
+                print(line.strip())
         print("-"*80)
-        for line in log[0]:
-            print(line.strip())
-        print("-"*80)
+        return input(f"Submit {len(new)} factors [N]:").lower() in ("y", "yes")
 
-        if input("Submit [N]:").lower() in ("y", "yes"):
-            print("Submitting")
-            params = _get_contribution_parameters(classification, log[0])
-            form_data = urllib.parse.urlencode(params).encode()
-
-            req = urllib.request.Request(contribute_url, data=form_data, method='POST')
-            with urllib.request.urlopen(req) as f:
-                data = f.read().decode()
-                received = "Contribution was received" in data
-                print("\tResponse:", f.code, "Contribution received:", received)
-                assert f.code == 200 and received, data
+    print(f"Checking {len(factors)} factors")
+    backend = stdkmd.HttpBackend(args.stdkmd_url)
+    received = stdkmd.check_and_submit(factors, confirm, backend)
+    print(f"{len(received)} contributions received")
     print()
 
 
 def main(args):
-    numbers, lookup = load_allcomp(args.allcomp)
+    numbers, lookup = allcomp.load_allcomp(args.allcomp)
+
+    if args.split and args.rank:
+        _rank_numbers_and_output_batches(args, numbers)
+        return
 
     if args.split:
-        _split_numbers_and_output_batches(numbers)
+        _split_numbers_and_output_batches(numbers, **_batch_cost_args(args))
+        return
+
+    if args.diff:
+        _print_allcomp_diff(args.diff, lookup)
         return
 
     if args.rebatch:
@@ -538,12 +1241,7 @@ def main(args):
         return
 
     assert args.logs, "No log filenames specified"
-    logs = get_logs(args.logs)
-    assert logs, "No logs found"
-    total_lines = sum(len(l) for l in logs.values())
-    print(f"{len(args.logs)} log files contained {total_lines} lines\n")
-
-    factors = parse_logs(logs)
+    factors = parse_logs(args.logs, args.jobs, args.incremental, args.log_index)
 
     # TODO something better here
     extra_factors = [
@@ -581,8 +1279,13 @@ def main(args):
     # Factor info
     if True:
         new = 0
+        to_submit = []
+        divides = product_tree.match_factors(factors, list(lookup))
+        pm1 = _factor_pm1_all(
+                [(f, n) for f in sorted(factors) for n in divides[f]],
+                args.factor_cache, os.cpu_count() or 1, args.factor_timeout)
         for f, log in sorted(factors.items()):
-            found = [n for n in lookup if n % f == 0]
+            found = divides[f]
             if not found:
                 # Number has already been submitted.
                 print (f"\n{number_with_digits(f)} already submitted")
@@ -592,12 +1295,19 @@ def main(args):
             print (f"\n{number_with_digits(f)} with {log_lines} log lines")
             new += 1
 
-            assert len(found) == 1, f"{f} divides {len(found)} numbers"
+            if len(found) > 1:
+                print(f"\tWARNING: {f} divides {len(found)} numbers")
             for n in found:
-                _handle_factor(f, n, args.submit, lookup[n], log)
+                classification = _handle_factor(f, n, lookup[n], pm1[(f, n)])
+                to_submit.append((f, classification, log[0]))
 
         print(new, "factors not yet in allcomp.txt")
 
+        # Submit numbers
+        if args.submit and to_submit:
+            print()
+            _submit_factors(to_submit, args)
+
 
 if __name__ == "__main__":
     parser = _get_argparser()
@@ -0,0 +1,110 @@
+"""Product and remainder trees for matching factors against many composites."""
+
+import math
+
+import gmpy2
+
+
+def product_tree(numbers, max_bits=None):
+    """
+    Build a product tree, tree[0] is the leaves and tree[-1] is [product].
+
+    With max_bits stop once the nodes of the top level average max_bits.
+    """
+    assert numbers
+    tree = [[gmpy2.mpz(n) for n in numbers]]
+    while len(tree[-1]) > 1:
+        level = tree[-1]
+        if max_bits and sum(n.bit_length() for n in level) >= max_bits * len(level):
+            break
+        tree.append([math.prod(level[i:i+2]) for i in range(0, len(level), 2)])
+    return tree
+
+
+def remainder_tree(x, tree):
+    """Compute x mod each leaf of tree."""
+    rems = [x % tree[-1][0]]
+    for level in reversed(tree[:-1]):
+        rems = [rems[i // 2] % value for i, value in enumerate(level)]
+    return rems
+
+
+def match_factors(factors, numbers):
+    """
+    Find which of numbers each factor divides.
+
+    Equivalent to {f: [n for n in numbers if n % f == 0]}.
+
+    Builds a product tree over numbers up to nodes about as large as the
+    product of factors and takes gcd(node, product of factors) for each node.
+    Only the few nodes with a common factor are walked down to the leaves.
+
+    Returns dict of factor -> list of numbers (in the order of numbers).
+    """
+    factors = sorted(set(factors))
+    found = {f: [] for f in factors}
+    if not factors or not numbers:
+        return found
+
+    factor_product = product_tree(factors)[-1][0]
+    tree = product_tree(numbers, max_bits=factor_product.bit_length())
+    level = len(tree) - 1
+
+    # (level, index, candidate factors), pushed in reverse so leaves pop in order.
+    stack = []
+    for index in reversed(range(len(tree[level]))):
+        g = gmpy2.gcd(tree[level][index], factor_product)
+        if g > 1:
+            stack.append((level, index, [f for f in factors if g % f == 0]))
+
+    while stack:
+        level, index, candidates = stack.pop()
+        value = tree[level][index]
+        candidates = [f for f in candidates if value % f == 0]
+        if not candidates:
+            continue
+
+        if level == 0:
+            for f in candidates:
+                found[f].append(numbers[index])
+            continue
+
+        children = tree[level - 1]
+        for child in (2 * index + 1, 2 * index):
+            if child < len(children):
+                stack.append((level - 1, child, candidates))
+
+    return found
+
+
+def find_divisors(numbers, composites):
+    """
+    For each n in numbers find the composites that divide it.
+
+    Batch GCD: with P the product of composites, P mod n is computed for every n
+    with a remainder tree and any composite dividing n also divides gcd(n, P mod n).
+
+    Returns {n: [composites]} for numbers with at least one divisor.
+    """
+    found = {}
+    if not numbers or not composites:
+        return found
+
+    composite_set = set(composites)
+    product = product_tree(composites)[-1][0]
+    rems = remainder_tree(product, product_tree(numbers))
+
+    for n, r in zip(numbers, rems):
+        g = gmpy2.gcd(n, r)
+        if g == 1:
+            continue
+
+        if g in composite_set:
+            found[n] = [int(g)]
+        else:
+            # Several composites divide n (or g is only part of one), rare so check directly.
+            divisors = [c for c in composites if g % c == 0]
+            if divisors:
+                found[n] = divisors
+
+    return found
@@ -0,0 +1,175 @@
+"""
+SQLite index of P-1/ECM resume lines.
+
+Only the small fields of each resume line are stored (hash of N, label,
+METHOD, B1, X0) along with the file and byte offset of the line. Files are
+ingested incrementally, only bytes appended since the last ingest are read.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+import allcomp
+import ecm_resume
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS residuals (
+    n_hash TEXT NOT NULL,
+    label TEXT,
+    method TEXT NOT NULL,
+    b1 INTEGER NOT NULL,
+    x0 TEXT,
+    file TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    PRIMARY KEY (file, offset)
+);
+CREATE INDEX IF NOT EXISTS residuals_n_b1 ON residuals (n_hash, b1);
+"""
+
+# Keys every resume line needs, same check as process_ecm_logs._validate_residual
+RESIDUAL_KEYS = ("METHOD", "N", "B1", "X", "X0", "CHECKSUM")
+
+
+def n_hash(n):
+    return hashlib.sha1(str(n).encode()).hexdigest()
+
+
+class ResidualStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _files_where(files):
+        """SQL condition and params limiting rows to files (all rows if None)."""
+        if files is None:
+            return "1", []
+        paths = [os.path.abspath(fn) for fn in files]
+        return f"file IN ({', '.join('?' * len(paths))})", paths
+
+    def count(self, files=None):
+        where, params = self._files_where(files)
+        return self.db.execute(f"SELECT COUNT(*) FROM residuals WHERE {where}", params).fetchone()[0]
+
+    def ingest(self, fn, lookup=None):
+        """
+        Add resume lines appended to fn since the last ingest.
+
+        lookup ({n: row} from allcomp) is used to fill in label.
+        Returns the number of new lines.
+        """
+        path = os.path.abspath(fn)
+        inode = os.stat(path).st_ino
+        size = os.path.getsize(path)
+
+        row = self.db.execute("SELECT inode, offset FROM files WHERE path = ?", (path,)).fetchone()
+        offset = 0
+        if row:
+            if row[0] == inode and row[1] <= size:
+                offset = row[1]
+            else:
+                # File was replaced or truncated, start over.
+                self.db.execute("DELETE FROM residuals WHERE file = ?", (path,))
+
+        added = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    # Partial line still being written
+                    break
+
+                line_offset = offset
+                offset += len(raw)
+                line = raw.decode().strip()
+                if not line:
+                    continue
+
+                parsed = ecm_resume.ResumeLine(line)
+                assert all(k in parsed for k in RESIDUAL_KEYS), \
+                        f"Bad residual line at {line_offset} in {fn}: {line[:40]}..."
+
+                n = parsed["N"]
+                if parsed.is_zero("X"):
+                    # See _rebatch_residuals, these lines are dropped
+                    print(f"\tDropping line at {line_offset} in {fn}: X=0 N={str(n)[:10]}...")
+                    continue
+
+                label = None
+                if lookup is not None and n in lookup:
+                    label = allcomp.row_label(lookup[n])
+
+                added.append((n_hash(n), label, parsed["METHOD"], parsed["B1"],
+                              str(parsed["X0"]), path, line_offset))
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO residuals VALUES (?, ?, ?, ?, ?, ?, ?)", added)
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, inode, offset))
+
+        return len(added)
+
+    def best(self, min_b1=0, method=None, files=None):
+        """
+        Yield (file, offset, B1) of the largest B1 residual for each N with B1 >= min_b1.
+
+        Only lines from files are considered if given. Ties go to the first ingested line.
+        """
+        where, params = self._files_where(files)
+        where += " AND b1 >= ?"
+        params.append(min_b1)
+        if method:
+            where += " AND method = ?"
+            params.append(method)
+
+        return self.db.execute(f"""
+            SELECT file, offset, b1 FROM (
+                SELECT file, offset, b1,
+                    ROW_NUMBER() OVER (PARTITION BY n_hash ORDER BY b1 DESC, rowid) AS rank
+                FROM residuals WHERE {where})
+            WHERE rank = 1""", params)
+
+    def best_b1(self, method=None):
+        """{n_hash: largest B1} of all residuals."""
+        where, params = ("WHERE method = ?", [method]) if method else ("", [])
+        return dict(self.db.execute(
+            f"SELECT n_hash, MAX(b1) FROM residuals {where} GROUP BY n_hash", params))
+
+    def read_lines(self, locations):
+        """
+        Yield resume lines for (file, offset, ...) locations, opening each file once.
+
+        Locations in files that were moved or deleted are skipped with a warning.
+        """
+        f = None
+        current = None
+        for location in sorted(locations):
+            path, offset = location[:2]
+            if path != current:
+                if f:
+                    f.close()
+                    f = None
+                current = path
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    print(f"\tSkipping residuals in missing file {path!r}")
+
+            if f is None:
+                continue
+            f.seek(offset)
+            yield f.readline().decode().strip()
+
+        if f:
+            f.close()
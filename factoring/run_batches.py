@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+Run GPU P-1 stage 1 in B1 steps (default 1e8) for resume batches while a CPU
+pool runs stage 2 on the save file of each finished step.
+
+All progress (and each batch's step and B2) is kept in a json state file so
+the script can be killed (or the instance preempted) and rerun with the same
+state file.
+
+    # Add two batches and run them up to B1=40e8 on GPUs 0 and 1
+    $ python run_batches.py state.json --add resumes/pm1_stdkmd_batch_0*.resume.txt \\
+        --limit 40e8 --gpus 0 1 --cpu-workers 8 --B2 1e14
+
+    # After a restart
+    $ python run_batches.py state.json --gpus 0 1 --cpu-workers 8
+
+ecm can be any executable taking the same arguments (e.g. a stand-in script for testing).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+
+import ecm_resume
+
+
+def _get_argparser():
+    parser = argparse.ArgumentParser(
+            description='Pipelined GPU stage 1 / CPU stage 2 runner for P-1 resume batches')
+
+    parser.add_argument('state', help='json state file (created if missing)')
+    parser.add_argument('--add', nargs='+', default=[], metavar='RESUME_FN',
+            help='resume files to add as new batches')
+    parser.add_argument('--limit', help='B1 to run new batches up to (e.g. 40e8)')
+    parser.add_argument('--start',
+            help='B1 of new batches (default: B1 of the first line)')
+    parser.add_argument('--step', default="1e8",
+            help='B1 increment of each GPU step of new batches')
+    parser.add_argument('--gpus', nargs='+', type=int, default=[0],
+            help='GPU devices to use (passed to ecm -gpudevice)')
+    parser.add_argument('--cpu-workers', type=int, default=os.cpu_count() or 1,
+            help='number of stage 2 processes')
+    parser.add_argument('--B2', default="0",
+            help='stage 2 bound of new batches, 0 to skip stage 2')
+    parser.add_argument('--ecm', default='./ecm', help='ecm executable')
+    return parser
+
+
+def _b1_name(B1):
+    """Same names as run_batches.sh, 4000000000 => "40e8"."""
+    return f"{B1 // 10 ** 8}e8" if B1 % 10 ** 8 == 0 else str(B1)
+
+
+def _batch_base(fn):
+    """pm1_stdkmd_batch_01_799.resume.txt => batch_01_799 (see run_batches.sh)."""
+    folder, name = os.path.split(fn)
+    base = re.sub(r'^pm1_stdkmd_(batch_[0-9]+_[0-9]+).resume.txt$', r'\1', name)
+    base = re.sub(r'(batch[_0-9]+)\.[0-9]+e[7-9].txt$', r'\1', base)
+    assert base != name, f"Unexpected resume filename: {name}"
+    return os.path.join(folder, base)
+
+
+class EcmError(Exception):
+    pass
+
+
+def _first_B1(fn):
+    with open(fn) as f:
+        for line in f:
+            if line.strip():
+                return ecm_resume.ResumeLine(line.strip())["B1"]
+    raise ValueError(f"No resume lines in {fn}")
+
+
+class Runner:
+    """
+    State is
+        {"batches": {base: {"last_fn", "B1", "limit", "step", "B2"}},
+         "stage2": {save_fn: {"B1", "B2", "parts": [part_fn], "done": [part_fn]}}}
+
+    --step and --B2 are saved with each new batch, entries from older state
+    files without them use the command line values.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.step = int(float(args.step))
+        self.B2 = int(float(args.B2))
+        self.state_fn = args.state
+        self.state = {"batches": {}, "stage2": {}}
+        if os.path.exists(self.state_fn):
+            with open(self.state_fn) as f:
+                self.state = json.load(f)
+        self.running = set()
+
+    def save_state(self):
+        with open(self.state_fn + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.state_fn + ".tmp", self.state_fn)
+
+    def add_batch(self, fn, start, limit):
+        base = _batch_base(fn)
+        if base in self.state["batches"]:
+            print(f"{base!r} already in state")
+            return
+
+        B1 = start if start else _first_B1(fn)
+        assert B1 < limit, (B1, limit)
+        self.state["batches"][base] = {
+            "last_fn": fn, "B1": B1, "limit": limit, "step": self.step, "B2": self.B2}
+        self.save_state()
+        print(f"Added {base!r} B1={B1:,} to {limit:,}")
+
+    async def run_cmd(self, cmd, log_fn):
+        """Run cmd with stdout appended to log_fn, returns if ecm didn't have an error (low bit)."""
+        print("\t", " ".join(cmd))
+        # Append (like tee -a in run_batches.sh) so a rerun step keeps the log of the interrupted run
+        with open(log_fn, "a") as log:
+            proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=log, stderr=asyncio.subprocess.STDOUT)
+            try:
+                returncode = await proc.wait()
+            except BaseException:
+                # Cancelled (another worker failed or Ctrl-C), don't leave ecm running.
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+                raise
+        return returncode % 2 == 0
+
+    def next_batch(self):
+        for base, batch in sorted(self.state["batches"].items()):
+            if base not in self.running and batch["B1"] < batch["limit"]:
+                return base
+        return None
+
+    async def gpu_worker(self, gpu, stage2_queue):
+        while True:
+            base = self.next_batch()
+            if base is None:
+                return
+
+            self.running.add(base)
+            try:
+                batch = self.state["batches"][base]
+                B2 = batch.get("B2", self.B2)
+                B1 = min(batch["B1"] + batch.get("step", self.step), batch["limit"])
+                new_fn = f"{base}.{_b1_name(B1)}.txt"
+                cmd = [self.args.ecm, "-v", "-gpu", "-gpudevice", str(gpu), "-pm1",
+                       "-resume", batch["last_fn"], "-save", new_fn + ".tmp", str(B1), "0"]
+                if not await self.run_cmd(cmd, new_fn + ".log"):
+                    raise EcmError(f"ecm failed for {base!r} B1={B1:,} on GPU {gpu}, see {new_fn}.log")
+
+                # Save file is only used once complete
+                os.replace(new_fn + ".tmp", new_fn)
+                batch["B1"] = B1
+                batch["last_fn"] = new_fn
+                if B2:
+                    self.state["stage2"][new_fn] = {"B1": B1, "B2": B2, "parts": [], "done": []}
+                self.save_state()
+
+                if B2:
+                    stage2_queue.put_nowait(new_fn)
+            finally:
+                self.running.discard(base)
+
+    def split_stage2(self, save_fn):
+        """Split save_fn into one resume file per CPU worker."""
+        job = self.state["stage2"][save_fn]
+        if job["parts"]:
+            return
+
+        with open(save_fn) as f:
+            lines = [line for line in f if line.strip()]
+
+        count = min(self.args.cpu_workers, len(lines))
+        for k in range(count):
+            part_fn = f"{save_fn}.stage2_{k:02d}.txt"
+            with open(part_fn, "w") as f:
+                f.writelines(lines[k::count])
+            job["parts"].append(part_fn)
+        self.save_state()
+
+    async def stage2_part(self, save_fn, part_fn, cpu_slots):
+        job = self.state["stage2"][save_fn]
+        async with cpu_slots:
+            B2 = job.get("B2", self.B2)
+            cmd = [self.args.ecm, "-v", "-pm1", "-resume", part_fn, str(job["B1"]), str(B2)]
+            log_fn = part_fn.removesuffix(".txt") + ".log"
+            offset = os.path.getsize(log_fn) if os.path.exists(log_fn) else 0
+            if not await self.run_cmd(cmd, log_fn):
+                raise EcmError(f"stage 2 failed for {part_fn!r}, see {log_fn}")
+
+        # Only this run's output, the log is appended to
+        with open(log_fn) as f:
+            f.seek(offset)
+            for line in f:
+                if "Factor found" in line:
+                    print(f"\t{part_fn}: {line.strip()}")
+
+        job["done"].append(part_fn)
+        if len(job["done"]) == len(job["parts"]):
+            print(f"Stage 2 done for {save_fn!r}")
+        self.save_state()
+
+    async def stage2_worker(self, stage2_queue, cpu_slots):
+        tasks = []
+        try:
+            while True:
+                save_fn = await stage2_queue.get()
+                if save_fn is None:
+                    break
+
+                self.split_stage2(save_fn)
+                job = self.state["stage2"][save_fn]
+                for part_fn in job["parts"]:
+                    if part_fn not in job["done"]:
+                        tasks.append(asyncio.create_task(self.stage2_part(save_fn, part_fn, cpu_slots)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self):
+        stage2_queue = asyncio.Queue()
+        cpu_slots = asyncio.Semaphore(self.args.cpu_workers)
+
+        # Stage 2 that was interrupted (or never started) before a restart
+        for save_fn, job in sorted(self.state["stage2"].items()):
+            if not job["parts"] or len(job["done"]) < len(job["parts"]):
+                stage2_queue.put_nowait(save_fn)
+
+        stage2 = asyncio.create_task(self.stage2_worker(stage2_queue, cpu_slots))
+        gpus = [asyncio.create_task(self.gpu_worker(gpu, stage2_queue)) for gpu in self.args.gpus]
+        try:
+            await asyncio.gather(*gpus)
+            stage2_queue.put_nowait(None)
+            await stage2
+        finally:
+            # On an error stop (and wait for) every running ecm
+            for task in gpus + [stage2]:
+                task.cancel()
+            await asyncio.gather(*gpus, stage2, return_exceptions=True)
+
+
+def main(args):
+    runner = Runner(args)
+    if args.add:
+        assert args.limit, "--add requires --limit"
+        limit = int(float(args.limit))
+        start = int(float(args.start)) if args.start else None
+        for fn in args.add:
+            runner.add_batch(fn, start, limit)
+
+    for base, batch in sorted(runner.state["batches"].items()):
+        print(f"{base!r} at B1={batch['B1']:,} of {batch['limit']:,}")
+
+    try:
+        asyncio.run(runner.run())
+    except EcmError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print("All batches done")
+
+
+if __name__ == "__main__":
+    parser = _get_argparser()
+    args = parser.parse_args()
+
+    main(args)
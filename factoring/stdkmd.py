@@ -0,0 +1,170 @@
+"""
+Check and submit factors to https://stdkmd.net/nrr/ with asyncio.
+
+Requests go through a pluggable backend with `async request(method, path, body)`
+returning (status, text). HttpBackend keeps a few http.client connections open
+(run in threads) so a local stand-in server can be used by changing base_url.
+"""
+
+import asyncio
+import http.client
+import time
+import urllib.parse
+
+
+BASE_URL = "https://stdkmd.net"
+
+# Results of check()
+KNOWN = "known"
+WAITING = "waiting"
+NEW = "new"
+
+
+class HttpBackend:
+    def __init__(self, base_url=BASE_URL, connections=4, timeout=60):
+        url = urllib.parse.urlsplit(base_url)
+        assert url.scheme in ("http", "https"), base_url
+        self.conn_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.timeout = timeout
+        self.connections = connections
+        self._idle = None
+
+    def _connect(self):
+        return self.conn_class(self.netloc, timeout=self.timeout)
+
+    def _request(self, conn, method, path, body):
+        headers = {}
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        for attempt in range(2):
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                response = conn.getresponse()
+                return response.status, response.read().decode()
+            except (http.client.HTTPException, ConnectionError):
+                # Server closed the kept alive connection, reconnect once.
+                # A POST (factor submission) the server may have already
+                # processed is never sent twice.
+                conn.close()
+                if attempt or (sent and method != "GET"):
+                    raise
+
+    async def request(self, method, path, body=None):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.connections):
+                self._idle.put_nowait(self._connect())
+
+        conn = await self._idle.get()
+        try:
+            return await asyncio.to_thread(self._request, conn, method, path, body)
+        finally:
+            self._idle.put_nowait(conn)
+
+    def close(self):
+        """Close idle connections, the next request opens new ones."""
+        while self._idle and not self._idle.empty():
+            self._idle.get_nowait().close()
+        self._idle = None
+
+
+class StdkmdClient:
+    def __init__(self, backend, min_interval=0.1):
+        self.backend = backend
+        self.min_interval = min_interval
+        self._lock = asyncio.Lock()
+        self._last = 0
+
+    async def _request(self, method, path, body=None):
+        # Rate limit, at most one request starts every min_interval seconds.
+        async with self._lock:
+            wait = self._last + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._last = time.monotonic()
+
+        return await self.backend.request(method, path, body)
+
+    @staticmethod
+    def contribute_path(classification):
+        return "/nrr/c.cgi?" + urllib.parse.urlencode({"q": classification})
+
+    async def check(self, classification, factor):
+        """Returns KNOWN, WAITING (on factor table update) or NEW."""
+        status, data = await self._request("GET", self.contribute_path(classification))
+        assert status == 200, status
+        assert len(data) > 2000, len(data)
+
+        if str(factor) in data or "This number has been factored." in data:
+            return KNOWN
+        if "Please wait until the factor table" in data:
+            return WAITING
+        return NEW
+
+    async def submit(self, classification, params):
+        """Submit params (see _get_contribution_parameters), returns if it was received."""
+        body = urllib.parse.urlencode(params).encode()
+        status, data = await self._request("POST", self.contribute_path(classification), body)
+        received = status == 200 and "Contribution was received" in data
+        print(f"\t{classification:12} Response: {status} Contribution received: {received}")
+        return received
+
+
+async def _check_and_submit(client, factors, confirm):
+    statuses = await asyncio.gather(
+        *(client.check(classification, f) for f, classification, _ in factors))
+
+    new = []
+    for (f, classification, params), status in zip(factors, statuses):
+        if status == KNOWN:
+            print(f"\t{classification:12} {f} ALREADY KNOWN")
+        elif status == WAITING:
+            print(f"\t{classification:12} {f} WAITING ON factor table UPDATE")
+        else:
+            new.append((f, classification, params))
+
+    if not new or not confirm(new):
+        return []
+
+    # Connections sat idle during confirm() and were probably closed by the
+    # server, a POST isn't retried once sent so start the submits on new ones.
+    if hasattr(client.backend, "close"):
+        client.backend.close()
+
+    # One failed submit shouldn't hide which of the others were received.
+    received = await asyncio.gather(
+        *(client.submit(classification, params) for _, classification, params in new),
+        return_exceptions=True)
+
+    print()
+    for (f, classification, _), ok in zip(new, received):
+        if isinstance(ok, BaseException):
+            print(f"\t{classification:12} {f} SUBMIT FAILED: {ok!r}")
+        else:
+            print(f"\t{classification:12} {f} {'received' if ok else 'NOT RECEIVED'}")
+    return [f for (f, _, _), ok in zip(new, received) if ok is True]
+
+
+def check_and_submit(factors, confirm, backend=None, min_interval=0.1):
+    """
+    Check all factors concurrently then submit the new ones in one batch.
+
+    factors is a list of (factor, classification, submit params)
+    confirm(new) is called once with the new factors and returns if they should be submitted.
+    Returns the list of factors that were received.
+    """
+    backend = backend or HttpBackend()
+
+    async def run():
+        client = StdkmdClient(backend, min_interval)
+        return await _check_and_submit(client, factors, confirm)
+
+    try:
+        return asyncio.run(run())
+    finally:
+        if hasattr(backend, "close"):
+            backend.close()